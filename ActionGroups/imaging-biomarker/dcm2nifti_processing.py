@@ -1,36 +1,163 @@
 #!/usr/bin/env python
 import argparse
-import dcmstack
 from glob import glob
 import pydicom
 import nibabel as nib
+from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
 import numpy as np
 import sys
 import os
 import json
 import time
 import logging
+import multiprocessing
+import multiprocessing.connection
+import shutil
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from nilearn import plotting
 import matplotlib.pyplot as plt
 import radiomics_utils as utils
+import feature_table
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--subject', type=str, default='R01-003',
-                        help='Subject ID (default: R01-003)')
-    parser.add_argument('--feature_store_name', type=str, default='nsclc-radiogenomics-imaging-feature-group',
-                        help='SageMaker Feature Store Group Name (default: nsclc-radiogenomics-imaging-feature-group)')
-    parser.add_argument('--offline_store_s3uri', type=str,
-                        help='SageMaker Feature Offline Store S3 URI Example: s3://multimodal-image-data-processed/nsclc-radiogenomics-multimodal-imaging-featurestore.')
-    
-    args = parser.parse_args()
-    
-    data_dir = '/opt/ml/processing/input/'
-    output_dir = '/opt/ml/processing/output/'
+# the only header fields the processing needs to group, order and align the files
+INDEX_TAGS = ['SOPInstanceUID', 'SeriesInstanceUID', 'Modality', 'FrameOfReferenceUID',
+              'InstanceNumber', 'ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing',
+              'NumberOfFrames']
+
+
+def index_dicoms(paths):
+    """
+    Read the header of every DICOM file once, without the pixel data, and group the files by series.
+
+    Returns {SeriesInstanceUID: {'modality', 'frame_of_reference', 'orientation', 'pixel_spacing', 'instances'}},
+    with the instances of each series ({'path', 'sop_instance_uid', 'instance_number', 'position'})
+    in instance number order.
+    """
+    series = {}
+    for path in paths:
+        dcm = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+        entry = series.setdefault(dcm.SeriesInstanceUID, {
+            'modality': dcm.get('Modality'),
+            'frame_of_reference': dcm.get('FrameOfReferenceUID'),
+            'orientation': [float(i) for i in dcm.ImageOrientationPatient] if 'ImageOrientationPatient' in dcm else None,
+            'pixel_spacing': [float(i) for i in dcm.PixelSpacing] if 'PixelSpacing' in dcm else None,
+            'instances': [],
+        })
+        entry['instances'].append({
+            'path': path,
+            'sop_instance_uid': dcm.get('SOPInstanceUID'),
+            'instance_number': int(dcm.InstanceNumber) if dcm.get('InstanceNumber') is not None else None,
+            'position': tuple(float(i) for i in dcm.ImagePositionPatient) if 'ImagePositionPatient' in dcm else None,
+        })
+    for entry in series.values():
+        entry['instances'].sort(key=lambda i: (i['instance_number'] is None, i['instance_number'] or 0))
+    return series
 
+
+def select_series(index, seg_series_uid):
+    """ Find the segmentation series and the CT series it was drawn on in the index, checking both are usable """
+    if seg_series_uid not in index:
+        raise Exception('segmentation series %s not found among the DICOM files' % seg_series_uid)
+    seg = index[seg_series_uid]
+    if seg['modality'] != 'SEG' or len(seg['instances']) != 1:
+        raise Exception('series %s is not a single DICOM SEG object' % seg_series_uid)
+
+    # the CT series sharing the segmentation's frame of reference, the largest if there are several
+    cts = [entry for uid, entry in index.items() if uid != seg_series_uid and entry['modality'] == 'CT']
+    if not cts:
+        raise Exception('no CT series found next to the segmentation')
+    matching = [entry for entry in cts if entry['frame_of_reference'] == seg['frame_of_reference']]
+    if not matching:
+        logger.warning('no CT series shares the segmentation frame of reference %s' % seg['frame_of_reference'])
+    ct = max(matching or cts, key=lambda entry: len(entry['instances']))
+
+    instance_numbers = [i['instance_number'] for i in ct['instances']]
+    if None in instance_numbers or len(set(instance_numbers)) != len(instance_numbers):
+        raise Exception('CT series has missing or duplicate instance numbers')
+    if any(i['position'] is None for i in ct['instances']):
+        raise Exception('CT series has slices without ImagePositionPatient')
+    if ct['orientation'] is None or ct['pixel_spacing'] is None:
+        raise Exception('CT series has no ImageOrientationPatient or PixelSpacing')
+    return ct, seg
+
+
+def stack_ct(ct_series):
+    """
+    Read the pixels of every CT slice once into a volume of the stored values, int16 for CT,
+    and return it as a NIfTI image in LAS voxel order with the DICOM rescale as scl_slope/scl_inter.
+    """
+    orientation = np.array(ct_series['orientation']).reshape(2, 3)
+    normal = np.cross(orientation[0], orientation[1])
+    instances = sorted(ct_series['instances'], key=lambda i: np.dot(i['position'], normal))
+    steps = np.diff([np.dot(i['position'], normal) for i in instances])
+    if len(steps) and (steps.min() <= 0 or steps.max() - steps.min() > 0.01 * steps.mean()):
+        raise Exception('CT slices are not evenly spaced')
+
+    volume = None
+    for k, instance in enumerate(instances):
+        dcm = pydicom.dcmread(instance['path'])
+        pixels = dcm.pixel_array
+        rescale = (float(dcm.get('RescaleSlope', 1)), float(dcm.get('RescaleIntercept', 0)))
+        if volume is None:
+            # 12 bit unsigned CT values fit in int16 like signed ones
+            dtype = np.int16 if pixels.dtype == np.uint16 and dcm.BitsStored < 16 else pixels.dtype
+            volume = np.empty((pixels.shape[1], pixels.shape[0], len(instances)), dtype=dtype)
+            slope, intercept = rescale
+        elif rescale != (slope, intercept):
+            raise Exception('CT slices have different rescale slopes or intercepts')
+        # data axes follow the DICOM columns, rows and slices
+        volume[:, :, k] = pixels.T
+
+    row_spacing, column_spacing = ct_series['pixel_spacing']
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[0] * column_spacing
+    affine[:3, 1] = orientation[1] * row_spacing
+    affine[:3, 2] = normal * (steps.mean() if len(steps) else 1.0)
+    affine[:3, 3] = instances[0]['position']
+    # DICOM patient coordinates are LPS, NIfTI RAS
+    affine = np.diag([-1., -1., 1., 1.]).dot(affine)
+
+    # LAS like dcmstack used to write, the segmentation reorientation relies on it
+    nii = nib.Nifti1Image(volume, affine)
+    nii = nii.as_reoriented(ornt_transform(io_orientation(affine), axcodes2ornt('LAS')))
+    nii.header.set_slope_inter(slope, intercept)
+    return nii
+
+
+def seg_frame_slices(dcm, ct_positions, affine, n_slices):
+    """
+    Map every frame of a DICOM SEG to the z index of its CT slice in the NIfTI volume.
+
+    Frame positions come from the per-frame functional groups and are matched to the nearest
+    CT slice position along the slice normal; the affine then gives that slice's index.
+    """
+    # NIfTI affines are in RAS, DICOM positions in LPS
+    lps = np.array([-1., -1., 1.])
+    spacing = np.linalg.norm(affine[:3, 2])
+    normal = affine[:3, 2] * lps / spacing
+    origin = np.dot(affine[:3, 3] * lps, normal)
+
+    frame_positions = np.array([[float(i) for i in frame.PlanePositionSequence[0].ImagePositionPatient]
+                                for frame in dcm.PerFrameFunctionalGroupsSequence])
+    frame_offsets = frame_positions.dot(normal)
+    slice_offsets = np.asarray(ct_positions, dtype=float).dot(normal)
+    nearest = np.abs(frame_offsets[:, np.newaxis] - slice_offsets[np.newaxis, :]).argmin(axis=1)
+    off_slice = np.abs(frame_offsets - slice_offsets[nearest]) > spacing / 2
+    if off_slice.any():
+        raise Exception('%d segmentation frames do not lie on a CT slice' % off_slice.sum())
+
+    slices = np.rint((slice_offsets[nearest] - origin) / spacing).astype(int)
+    if slices.min() < 0 or slices.max() >= n_slices:
+        raise Exception('segmentation frames map outside the CT volume')
+    return slices
+
+
+def process_subject(subject, data_dir, output_dir):
+    """ Convert one subject's CT and segmentation DICOMs to NIfTI and compute its radiomic features """
     # assume one subject comes in,
     # we need to find out where the CT dicom files are
     # and segmentation file
@@ -56,56 +183,43 @@ if __name__ == '__main__':
 
     print(file_info)
     
-    src_dcms = glob(os.path.join(data_dir, file_info[0][0], file_info[0][1], '*', '*dcm'))
-    src_seg_dcm = [i for i in src_dcms if file_info[0][2] in i]
+    # one header-only read of every file, everything below works from this index
+    index = index_dicoms(glob(os.path.join(data_dir, file_info[0][0], file_info[0][1], '*', '*dcm')))
+    ct_series, seg_series = select_series(index, file_info[0][2])
+    src_dcms = [i['path'] for i in ct_series['instances']]
+    src_seg_dcm = [i['path'] for i in seg_series['instances']]
     logging.info(src_seg_dcm)
-    src_dcms.remove(src_seg_dcm[0])
-    #print(src_dcms)
     print('# of src_dcms: %d' % len(src_dcms))
     print('# of src_seg_dcm: %d' % len(src_seg_dcm))
 
     # work with CT scan and load as a Nifti image
     logger.info('Creating nifti images from DICOM files')
-    stacks = dcmstack.parse_and_stack(src_dcms)
-    stack = list(stacks.values())[0]
-    nii = stack.to_nifti()
-    img = nii.get_fdata()
+    nii = stack_ct(ct_series)
 
     # work with CT segmentation file, load as a numpy array and create a Nifti image
     dcm = pydicom.dcmread(src_seg_dcm[0])
-    n_frames_seg = int(dcm.NumberOfFrames)
-    seg = dcm.pixel_array
-    # reorient the seg array
-    seg = np.fliplr(seg.T)
-    
-    # if seg and img don't have the same dimension, pad the images
-    if img.shape != seg.shape:
-        # read all dicoms and parse out the instance number and slice location
-        # assuming the files are from R01-098 onwards with ePAD Generated DSO
-        d_sort_instance_number=[]
-        for tmp_dcm_fname in src_dcms:
-            tmp_dcm = pydicom.dcmread(tmp_dcm_fname)
-            d_sort_instance_number.append((int(tmp_dcm[0x0020, 0x0013].value), tmp_dcm[0x0020, 0x0032].value))
-        d_sort_instance_number = sorted(d_sort_instance_number, key=lambda aa: aa[0])
-        
-        patient_img_position_first = dcm[0x5200, 0x9230][0][0x0020, 0x9113][0]['ImagePositionPatient'].value
-        patient_img_position_last = dcm[0x5200, 0x9230][-1][0x0020, 0x9113][0]['ImagePositionPatient'].value
-        
-        slice_instance_number_1 = [i for i, j in d_sort_instance_number if j == patient_img_position_first][0]
-        slice_instance_number_2 = [i for i, j in d_sort_instance_number if j == patient_img_position_last][0]
-        top_slice_instance_number = min(slice_instance_number_1, slice_instance_number_2)
-
-#     logger.debug(np.nonzero(seg.sum(axis=1).sum(axis=1))[0])
-        tmp_seg = np.zeros_like(img)
-        starting_index = img.shape[-1] - top_slice_instance_number - n_frames_seg # the seg and the image is flipped and need to locate from bottom.
-        ending_index = starting_index + n_frames_seg
-        tmp_seg[:, :, starting_index:ending_index] = seg
-        seg = tmp_seg
+    frames = dcm.pixel_array
+    if frames.ndim == 2:
+        frames = frames[np.newaxis]
+    # reorient the seg frames to the CT in-plane axes, frames end up on the last axis
+    frames = np.fliplr(frames.T)
+    if frames.shape[:2] != nii.shape[:2]:
+        raise Exception('segmentation frames are %s, CT slices %s' % (frames.shape[:2], nii.shape[:2]))
+
+    # place every frame on the CT slice it was drawn on, frames need not be contiguous nor in order
+    slices = seg_frame_slices(dcm, [i['position'] for i in ct_series['instances']], nii.affine, nii.shape[-1])
+    seg = np.zeros(nii.shape, dtype=np.uint8)
+    if len(np.unique(slices)) == len(slices):
+        seg[:, :, slices] = frames > 0
+    else:
+        # frames of several segments share a slice, keep their union
+        np.maximum.at(seg, (slice(None), slice(None), slices), (frames > 0).astype(np.uint8))
     seg_nii = nib.Nifti1Image(seg, nii.affine, header = nii.header)
+    seg_nii.set_data_dtype(np.uint8)
 
     # save some viz
     logger.info('Saving files.')
-    prefix = '%s' % (args.subject)
+    prefix = '%s' % (subject)
     f1 = plt.figure(figsize=(16,6))
     g1 = plotting.plot_roi(seg_nii, bg_img = nii, figure = f1, alpha = 0.4, title = 'Lung CT with segmentation')
     g1.savefig(os.path.join(output_dir, 'PNG', '%s_ortho-view.png' % prefix), dpi = 150)
@@ -123,13 +237,19 @@ if __name__ == '__main__':
     
     # compute radiomic features
     logging.info('Computing radiomic features')
-    df = utils.compute_features(imageName, maskName)
+    # only the tumor region goes to PyRadiomics, straight from memory
+    image, mask = utils.crop_to_mask(nii, seg_nii)
+    df = utils.compute_features(imageName, maskName, image, mask)
+    current_time_sec = float(round(time.time()))
+
+    # typed Parquet partition, bulk loaded into redshift with the rest of the batch
+    feature_table.write_partition(feature_table.feature_frame(df, subject, file_info[0][1], current_time_sec),
+                                  os.path.join(output_dir, 'PARQUET'))
     
     # format dataframe for redshift
     record_id_column = 'Subject'
     event_time_column = 'EventTime'
-    df[record_id_column] = args.subject
-    current_time_sec = float(round(time.time()))
+    df[record_id_column] = subject
     df[event_time_column] = current_time_sec
     df['ScanDate'] = file_info[0][1]
     utils.cast_object_to_string(df)
@@ -147,3 +267,138 @@ if __name__ == '__main__':
     
     print('Processing done for %s' % prefix)
     logging.info('Processing done for %s' % prefix)
+
+
+def download_subject(input_s3uri, subject, local_dir, max_workers=16):
+    """ Copy the s3://.../<subject>/ prefix to local_dir, several objects at a time """
+    import boto3
+
+    bucket, _, prefix = input_s3uri.replace('s3://', '').partition('/')
+    prefix = '%s/%s/' % (prefix.rstrip('/'), subject) if prefix else '%s/' % subject
+    s3 = boto3.client('s3')
+    keys = [obj['Key'] for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])]
+    if not keys:
+        raise FileNotFoundError('No input data under s3://%s/%s' % (bucket, prefix))
+
+    def download(key):
+        path = os.path.join(local_dir, os.path.relpath(key, prefix))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        s3.download_file(bucket, key, path)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(download, keys))
+
+
+def _subject_worker(subject, data_dir, output_dir, input_s3uri):
+    """ Process entry point: the exit code tells the parent whether the subject succeeded """
+    subject_dir = os.path.join(data_dir, subject)
+    try:
+        if input_s3uri:
+            download_subject(input_s3uri, subject, subject_dir)
+        process_subject(subject, subject_dir, output_dir)
+    except Exception:
+        logger.error('Processing failed for %s\n%s' % (subject, traceback.format_exc()))
+        sys.exit(1)
+    finally:
+        if input_s3uri:
+            # downloaded inputs are not needed anymore, keep the volume free for the next subjects
+            shutil.rmtree(subject_dir, ignore_errors=True)
+
+
+def process_subjects(subjects, data_dir, output_dir, workers, input_s3uri=None, batch=None):
+    """
+    Process several subjects in one job, each in its own process, at most workers at a time.
+
+    A subject that raises, runs out of memory or crashes the interpreter only ends its own
+    process, the others carry on. Writes STATUS/<batch>/<subject>.json for every subject as
+    it finishes, STATUS/<subject>.json without a batch, and returns the statuses.
+    """
+    status_dir = os.path.join(output_dir, 'STATUS', batch) if batch else os.path.join(output_dir, 'STATUS')
+    os.makedirs(status_dir, exist_ok=True)
+    pending = list(subjects)
+    running = {}
+    statuses = []
+    start = time.time()
+    while pending or running:
+        while pending and len(running) < workers:
+            subject = pending.pop(0)
+            process = multiprocessing.Process(target=_subject_worker,
+                                              args=(subject, data_dir, output_dir, input_s3uri))
+            process.start()
+            running[process.sentinel] = (subject, process, time.time())
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            subject, process, started = running.pop(sentinel)
+            process.join()
+            status = {
+                'subject': subject,
+                'status': 'Succeeded' if process.exitcode == 0 else 'Failed',
+                'exit_code': process.exitcode,
+                'seconds': round(time.time() - started, 1),
+            }
+            # written aside and renamed, so the continuous upload never sees a partial file
+            path = os.path.join(status_dir, '%s.json' % subject)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(status, f)
+            os.replace(path + '.tmp', path)
+            logger.info('%s %s in %.1f s' % (subject, status['status'], status['seconds']))
+            statuses.append(status)
+
+    elapsed = time.time() - start
+    succeeded = sum(status['status'] == 'Succeeded' for status in statuses)
+    logger.info('%d of %d subjects succeeded in %.1f s with %d workers: %.1f subjects/hour'
+                % (succeeded, len(statuses), elapsed, workers, succeeded * 3600 / elapsed if elapsed else 0))
+    return statuses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subject', type=str, default='R01-003',
+                        help='Subject ID (default: R01-003)')
+    parser.add_argument('--subjects', type=str,
+                        help='JSON array or comma separated list of subject IDs processed in one job, '
+                             'each read from <input>/<subject>/ or downloaded from --input_s3uri')
+    parser.add_argument('--input_s3uri', type=str,
+                        help='S3 URI holding one prefix per subject, downloaded by the job in --subjects mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Subjects processed in parallel in --subjects mode (default: CPU count)')
+    parser.add_argument('--feature_classes', type=str,
+                        help='Comma separated PyRadiomics feature classes to compute, e.g. firstorder,shape '
+                             '(default: every class enabled by the params)')
+    parser.add_argument('--radiomics_params', type=str,
+                        help='PyRadiomics parameter file (default: PyRadiomics defaults)')
+    parser.add_argument('--output_s3uri', type=str,
+                        help='S3 URI the outputs are uploaded to; in --subjects mode a Redshift manifest of the '
+                             'batch is written to PARQUET/_batches/ for feature_table.load_batch')
+    parser.add_argument('--batch', type=str, default=time.strftime('%Y%m%d-%H%M%S'),
+                        help='Name of the batch manifest and of the STATUS prefix (default: the start time)')
+    parser.add_argument('--feature_store_name', type=str, default='nsclc-radiogenomics-imaging-feature-group',
+                        help='SageMaker Feature Store Group Name (default: nsclc-radiogenomics-imaging-feature-group)')
+    parser.add_argument('--offline_store_s3uri', type=str,
+                        help='SageMaker Feature Offline Store S3 URI Example: s3://multimodal-image-data-processed/nsclc-radiogenomics-multimodal-imaging-featurestore.')
+    
+    args = parser.parse_args()
+    
+    data_dir = '/opt/ml/processing/input/'
+    output_dir = '/opt/ml/processing/output/'
+
+    # built once here, subject processes inherit it
+    utils.configure_extractor(args.radiomics_params,
+                              [i.strip() for i in args.feature_classes.split(',')] if args.feature_classes else None)
+
+    if args.subjects:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(message)s')
+        subjects = args.subjects.strip()
+        subjects = json.loads(subjects) if subjects.startswith('[') else [i.strip() for i in subjects.split(',') if i.strip()]
+        os.makedirs(data_dir, exist_ok=True)
+        statuses = process_subjects(subjects, data_dir, output_dir, args.workers, args.input_s3uri, args.batch)
+        if args.output_s3uri:
+            manifest = feature_table.write_manifest(os.path.join(output_dir, 'PARQUET'),
+                                                    '%s/PARQUET' % args.output_s3uri.rstrip('/'),
+                                                    [status['subject'] for status in statuses
+                                                     if status['status'] == 'Succeeded'], args.batch)
+            logger.info('Batch manifest %s' % manifest)
+        if not any(status['status'] == 'Succeeded' for status in statuses):
+            sys.exit('Processing failed for every subject')
+    else:
+        process_subject(args.subject, data_dir, output_dir)
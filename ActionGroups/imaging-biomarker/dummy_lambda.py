@@ -5,6 +5,13 @@ import boto3
 import io
 import pandas as pd
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+import pyarrow.parquet as pq
+from botocore.config import Config
+import feature_table
 
 # Get environment variables
 sfn_statemachine_name = os.environ['SFN_STATEMACHINE_NAME']
@@ -15,16 +22,252 @@ bucketname = s3bucket.replace("s3://", "")
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
+# subjects fetched at once; the client is shared by the threads and reused while the Lambda stays warm
+MAX_WORKERS = 32
+s3_client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS))
+sfn_client = boto3.client('stepfunctions')
+
+# the imaging state machine state running the processing job
+PROCESSING_STATE = 'DICOM/NIfTI Conversion and Radiomic Feature Extraction'
+# status of executions that have ended, by ARN, status of the subjects that finished, by (batch, subject),
+# and feature partitions of subjects processed by executions past their processing job, by (ARN, subject);
+# none changes anymore. At most CACHE_SIZE of each are kept
+CACHE_SIZE = 256
+_finished_executions = {}
+_finished_subjects = {}
+_finished_partitions = {}
+_cache_lock = threading.Lock()
+
+
+def _remember(cache, key, value):
+    """ Keep value in a cache of at most CACHE_SIZE entries, dropping the oldest """
+    with _cache_lock:
+        cache[key] = value
+        while len(cache) > CACHE_SIZE:
+            del cache[next(iter(cache))]
+    return value
+
+
+# columns of every partition that are not features
+KEY_COLUMNS = ['subject', 'scan_date']
+# agent action group responses are limited to 25KB, features beyond this budget are left out
+MAX_BODY_BYTES = 20000
+# statistics across subjects analyze_imaging_biomarker can return instead of the per-subject values
+AGGREGATES = ('count', 'mean', 'std', 'min', 'max', 'median', 'quantiles')
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def list_param(value):
+    """ A list parameter of the agent, a JSON array or a comma separated string """
+    try:
+        values = json.loads(value)
+    except ValueError:
+        values = value.strip().strip('[]').split(',')
+    if isinstance(values, str):
+        values = values.split(',')
+    return [str(v).strip().strip('"\'') for v in values if str(v).strip()]
+
+
+def select_columns(names, features):
+    """
+    The columns among names that features asks for: feature names or glob patterns such as original_shape_*,
+    in PyRadiomics or column spelling (wavelet-LLH_firstorder_Mean or wavelet_llh_firstorder_mean).
+    """
+    patterns = [re.sub(r'[^0-9a-z_*?\[\]]', '_', feature.lower()) for feature in features]
+    return [name for name in names if name in KEY_COLUMNS or any(fnmatchcase(name, p) for p in patterns)]
+
+
+def _csv_table(data, subject_id):
+    """ The typed partition of a subject processed before the Parquet partitions existed, from its CSV file """
+    df = pd.read_csv(io.BytesIO(data), index_col=0, dtype={'ScanDate': str}, float_precision='round_trip')
+    return feature_table.feature_frame(df.drop(columns=['Subject', 'EventTime', 'ScanDate']),
+                                       subject_id, df['ScanDate'].iloc[0], df['EventTime'].iloc[0])
+
+
+def read_subject_features(subject_ids, features=None, execution_arns=None, max_workers=MAX_WORKERS):
+    """
+    Fetch the feature partition of every subject concurrently into one DataFrame, a row per subject in
+    subject_ids order. With features, only the matching columns are decoded. Subjects without a
+    partition are read from their CSV file instead. Subjects that cannot be read are left out and
+    returned as errors. execution_arns, one per subject, are the executions that processed them:
+    their partitions are cached.
+    """
+    def fetch(subject_id):
+        try:
+            key = f'nsclc_radiogenomics/PARQUET/{feature_table.partition_key(subject_id)}'
+            return 'parquet', s3_client.get_object(Bucket=bucketname, Key=key)['Body'].read()
+        except s3_client.exceptions.NoSuchKey:
+            key = f'nsclc_radiogenomics/CSV/{subject_id}.csv'
+            return 'csv', s3_client.get_object(Bucket=bucketname, Key=key)['Body'].read()
+
+    def read(subject_id, execution_arn):
+        partition = _finished_partitions.get((execution_arn, subject_id))
+        if partition is None:
+            partition = fetch(subject_id)
+            if execution_arn is not None:
+                _remember(_finished_partitions, (execution_arn, subject_id), partition)
+        file_format, data = partition
+        if file_format == 'csv':
+            table = _csv_table(data, subject_id)
+            return table[select_columns(table.columns, features)] if features else table
+        parquet = pq.ParquetFile(io.BytesIO(data))
+        columns = select_columns(parquet.schema_arrow.names, features) if features else None
+        return parquet.read(columns=columns).to_pandas()
+
+    frames = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(subject_ids) or 1)) as executor:
+        futures = [executor.submit(read, subject_id, execution_arn) for subject_id, execution_arn
+                   in zip(subject_ids, execution_arns or [None] * len(subject_ids))]
+        for subject_id, future in zip(subject_ids, futures):
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                logger.warning(f"Reading features of {subject_id} failed: {e}")
+                errors.append({"subject_id": subject_id, "error": str(e)})
+    features = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=KEY_COLUMNS)
+    return features.rename(columns={'subject': 'subject_id'}), errors
+
+
+def aggregate_features(features, aggregates):
+    """ Statistics of every feature column across subjects, {feature: {statistic: value}} """
+    unknown = set(aggregates) - set(AGGREGATES)
+    if unknown:
+        raise ValueError(f"Unknown aggregates {', '.join(sorted(unknown))}, expected some of {', '.join(AGGREGATES)}")
+    values = features.drop(columns=['subject_id', 'scan_date', 'event_time'], errors='ignore')
+    if values.columns.empty:
+        # no subject is done yet
+        return pd.DataFrame()
+    statistics = []
+    simple = [a for a in aggregates if a != 'quantiles']
+    if simple:
+        statistics.append(values.agg(simple))
+    if 'quantiles' in aggregates:
+        quantiles = values.quantile(list(QUANTILES))
+        quantiles.index = [f'q{q * 100:g}' for q in QUANTILES]
+        statistics.append(quantiles)
+    return pd.concat(statistics).T
+
+
+def fit_features(names, serialize, budget):
+    """
+    The leading feature names whose serialization fits in budget bytes, found by bisection, and
+    that serialization. All of them when they fit.
+    """
+    body = serialize(names)
+    if len(body) <= budget:
+        return names, body
+    low, high = 0, len(names) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if len(serialize(names[:middle])) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return names[:low], serialize(names[:low])
+
+
+def analysis(subject_ids, features=None, aggregates=None, errors=(), execution_arns=None, budget=MAX_BODY_BYTES):
+    """
+    JSON members with the features of subject_ids, per subject or aggregated, and the errors
+    after the given ones, serialized once for all subjects. Features that do not fit in budget
+    bytes are left out and counted in a truncated member.
+    """
+    values, read_errors = read_subject_features(subject_ids, features, execution_arns)
+    errors = list(errors) + read_errors
+    logger.info(f"Features of {len(values)} subjects read, {len(errors)} failed")
+    if features and len(values) and not set(values.columns) - {'subject_id', 'scan_date'}:
+        errors.append({"error": f"No feature matches {', '.join(features)}"})
+    keys = [name for name in values.columns if name in ('subject_id', 'scan_date', 'event_time')]
+    names = [name for name in values.columns if name not in keys]
+    if aggregates:
+        try:
+            table = aggregate_features(values, aggregates)
+        except ValueError as e:
+            errors.append({"error": str(e)})
+            return '"errors": %s' % json.dumps(errors)
+        kept, body = fit_features(names, lambda subset: table.loc[subset].to_json(orient='index'),
+                                  budget - len(json.dumps(errors)))
+        members = '"subjects": %d, "aggregates": %s' % (len(values), body)
+    else:
+        kept, body = fit_features(names, lambda subset: values[keys + subset].to_json(orient='records'),
+                                  budget - len(json.dumps(errors)))
+        members = '"features": %s' % body
+    if len(kept) < len(names):
+        members += ', "truncated": %s' % json.dumps({
+            "features_returned": len(kept), "features_total": len(names),
+            "message": "The response size is limited, pass features (e.g. original_shape_*) or aggregate "
+                       "to get the features that were left out"})
+    return '%s, "errors": %s' % (members, json.dumps(errors))
+
+
+def _subject_status(subject_id, batch):
+    """ Status of a subject in STATUS/<batch>/<subject>.json, uploaded by the processing job as the subject finishes """
+    status = _finished_subjects.get((batch, subject_id))
+    if status is None:
+        try:
+            response = s3_client.get_object(Bucket=bucketname, Key=f'nsclc_radiogenomics/STATUS/{batch}/{subject_id}.json')
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        try:
+            status = json.loads(response['Body'].read())['status']
+        except (ValueError, KeyError):
+            # caught mid-upload, still pending
+            return None
+        status = _remember(_finished_subjects, (batch, subject_id), status)
+    return status
+
+
+def execution_status(execution_arn):
+    """
+    Progress of an imaging execution: its status, the state it is in and the status of every subject,
+    Succeeded or Failed from the STATUS files as subjects finish, Pending until then while the execution
+    runs and Missing once it has ended. Executions that have ended do not change anymore and are
+    answered from cache.
+    """
+    if execution_arn in _finished_executions:
+        return _finished_executions[execution_arn]
+    execution = sfn_client.describe_execution(executionArn=execution_arn)
+    execution_input = json.loads(execution['input'])
+    subjects = execution_input.get('Subject') or []
+    subjects = [subjects] if isinstance(subjects, str) else subjects
+    # the latest events are enough to tell the current state
+    events = sfn_client.get_execution_history(executionArn=execution_arn, reverseOrder=True, maxResults=20)['events']
+    state = next((e['stateEnteredEventDetails']['name'] for e in events if 'stateEnteredEventDetails' in e), None)
+    status = execution['status']
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(subjects) or 1)) as executor:
+        statuses = dict(zip(subjects, executor.map(
+            lambda subject_id: _subject_status(subject_id, execution_input['PreprocessingJobName']), subjects)))
+    missing = 'Pending' if status == 'RUNNING' else 'Missing'
+    result = {
+        "execution_arn": execution_arn,
+        "status": status,
+        "state": state,
+        "started": execution['startDate'].isoformat(),
+        "stopped": execution['stopDate'].isoformat() if 'stopDate' in execution else None,
+        "subjects": {subject_id: subject_status or missing for subject_id, subject_status in statuses.items()},
+    }
+    if status != 'RUNNING':
+        _remember(_finished_executions, execution_arn, result)
+    return result
+
+
 def lambda_handler(event, context):
     logger.info(json.dumps(event))
 
+    # invoked by the imaging state machine once a processing job is done, not by the agent
+    if "feature_manifest" in event:
+        return feature_table.load_batch(event["feature_manifest"])
+
     # Get the current region and account ID
     region = context.invoked_function_arn.split(":")[3]
     account_id = context.invoked_function_arn.split(":")[4]
 
     action = event["actionGroup"]
     function = event["function"]
-    parameters = event["parameters"]
+    parameters = event.get("parameters", [])
+    session_attributes = dict(event.get('sessionAttributes') or {})
+    output_data_uri = f'{s3bucket}/nsclc_radiogenomics/'
     print(parameters)
     
     if function == "compute_imaging_biomarker":
@@ -58,48 +301,75 @@ def lambda_handler(event, context):
             
             response_body = {
                 "TEXT": {
-                    "body": f"Imaging biomarker processing has been submitted. Results can be retrieved from your database once the job {execution_response['executionArn']} completes."
+                    "body": f"Imaging biomarker processing has been submitted. Follow its progress with get_imaging_biomarker_status; results can be retrieved from your database once the job {execution_response['executionArn']} completes."
                 }
             }
             
-        session_attributes = {
-            'sfn_executionArn': execution_response['executionArn'],
-            'imaging_biomarker_output_s3': output_data_uri
-        }
+            session_attributes['sfn_executionArn'] = execution_response['executionArn']
 
     elif function == "analyze_imaging_biomarker":
-        subject_id = None
-        result = []
-        s3_client = boto3.client('s3')
+        subject_id = []
+        features = None
+        aggregates = []
+        output_data_uri = f'{s3bucket}/nsclc_radiogenomics/'
         for param in parameters:
             if param["name"] == "subject_id":
                 subject_id = json.loads(param["value"])
-                for id in subject_id:
-                    output_data_uri = f'{s3bucket}/nsclc_radiogenomics/'
-                    bucket_name = bucketname
-                    object_key = f'nsclc_radiogenomics/CSV/{id}.csv'
-                    try:
-                        print(object_key)
-                        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-                        csv_data = response['Body'].read().decode('utf-8')
-                    
-                        df = pd.read_csv(io.StringIO(csv_data))
-                        df['subject_id'] = id
-                        print(df.head())
-                        json_data = df.to_json(orient='records')
-        
-                        print(json_data)
-                        result = result + json.loads(json_data)
-        
-                    except Exception as e:
-                        print(f'Error: {e}')
-        
+            elif param["name"] == "features":
+                features = list_param(param["value"]) or None
+            elif param["name"] == "aggregate":
+                aggregates = [a.lower() for a in list_param(param["value"])]
+        body = '{%s}' % analysis(subject_id, features, aggregates)
         response_body = {
             "TEXT": {
-                'body': str(result)
+                'body': body
             }
         }
-    
+
+    elif function == "get_imaging_biomarker_status":
+        execution_arns = []
+        features = None
+        aggregates = []
+        for param in parameters:
+            if param["name"] == "execution_arn":
+                execution_arns = list_param(param["value"])
+            elif param["name"] == "features":
+                features = list_param(param["value"]) or None
+            elif param["name"] == "aggregate":
+                aggregates = [a.lower() for a in list_param(param["value"])]
+        if not execution_arns and session_attributes.get('sfn_executionArn'):
+            execution_arns = [session_attributes['sfn_executionArn']]
+
+        executions = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(execution_arns) or 1)) as executor:
+            futures = [executor.submit(execution_status, arn) for arn in execution_arns]
+            for execution_arn, future in zip(execution_arns, futures):
+                try:
+                    executions.append(future.result())
+                except Exception as e:
+                    logger.warning(f"Status of {execution_arn} failed: {e}")
+                    errors.append({"execution_arn": execution_arn, "error": str(e)})
+        if not execution_arns:
+            errors.append({"error": "No imaging job has been started in this session, pass its execution_arn"})
+
+        if features or aggregates:
+            # features of the subjects that are done only; partitions are uploaded when the processing job ends
+            finished = [(subject_id, execution["execution_arn"]) for execution in executions
+                        if execution["state"] != PROCESSING_STATE
+                        for subject_id, status in execution["subjects"].items() if status == 'Succeeded']
+            executions_json = json.dumps(executions)
+            body = '{"executions": %s, %s}' % (executions_json, analysis(
+                [subject_id for subject_id, _ in finished], features, aggregates, errors,
+                [execution_arn for _, execution_arn in finished], MAX_BODY_BYTES - len(executions_json)))
+        else:
+            body = json.dumps({"executions": executions, "errors": errors})
+        response_body = {
+            "TEXT": {
+                'body': body
+            }
+        }
+
     logger.info(f"Response body: {response_body}")
 
     function_response = {
@@ -110,9 +380,7 @@ def lambda_handler(event, context):
         }
     }
     
-    session_attributes = {
-        'imaging_biomarker_output_s3': output_data_uri
-    }
+    session_attributes['imaging_biomarker_output_s3'] = output_data_uri
     # prompt_session_attributes = event['promptSessionAttributes']
     
     action_response = {
@@ -0,0 +1,176 @@
+"""
+Radiomic features as typed Parquet partitions, and their bulk load into Redshift.
+
+The processing job writes one partition per subject, PARQUET/subject=<id>/<id>.parquet,
+every feature a float64 column, and a Redshift manifest listing the partitions of its batch.
+load_batch then loads the whole batch with a single COPY, replacing the rows of subjects
+processed before, so the features can be queried and joined with clinical_genomic. Features
+a batch has that the table lacks are added as columns.
+
+Only needs pandas, pyarrow and boto3: it runs in the processing container and in the imaging Lambda.
+"""
+import io
+import json
+import logging
+import os
+import re
+import time
+
+import boto3
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TABLE = 'imaging_features'
+CLUSTER = 'biomarker-redshift-cluster'
+DATABASE = 'dev'
+DB_USER = 'admin'
+# columns of every row ahead of the features
+KEY_COLUMNS = ['subject', 'scan_date', 'event_time']
+_COMMENTS = {
+    'subject': 'Subject (case) ID of the clinical_genomic patient, e.g. R01-003',
+    'scan_date': 'Date of the CT scan the features were computed on',
+    'event_time': 'Seconds since the epoch when the features were computed',
+}
+_REDSHIFT_TYPES = {'float64': 'DOUBLE PRECISION', 'object': 'VARCHAR(256)'}
+
+
+def column_name(feature):
+    """ Redshift column of a PyRadiomics feature, e.g. wavelet-LLH_firstorder_Mean -> wavelet_llh_firstorder_mean """
+    return re.sub(r'[^0-9a-z_]', '_', feature.lower())
+
+
+def feature_frame(df, subject, scan_date, event_time):
+    """
+    The features of a compute_features row as a typed table: subject, scan_date and event_time,
+    then one float64 column per feature. Diagnostics and file names are left out.
+    """
+    features = [name for name in df.columns
+                if not name.startswith('diagnostics_') and name not in ('imageName', 'maskName')]
+    table = pd.DataFrame({'subject': [subject], 'scan_date': [scan_date], 'event_time': [float(event_time)]},
+                         columns=KEY_COLUMNS)
+    values = df[features].astype(np.float64).reset_index(drop=True)
+    values.columns = [column_name(name) for name in features]
+    return pd.concat([table, values], axis=1)
+
+
+def partition_key(subject):
+    return 'subject=%s/%s.parquet' % (subject, subject)
+
+
+def write_partition(table, parquet_dir):
+    """ Write the typed rows of one subject as its Parquet partition under parquet_dir, return the path """
+    path = os.path.join(parquet_dir, partition_key(table['subject'].iloc[0]))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table.to_parquet(path, index=False)
+    return path
+
+
+def write_manifest(parquet_dir, parquet_s3uri, subjects, batch):
+    """
+    Write the Redshift manifest of a batch, _batches/<batch>.manifest under parquet_dir, listing the
+    partitions of subjects once uploaded to parquet_s3uri. Subjects without a partition are skipped.
+    Return the S3 URI the manifest will have, or None when no subject has a partition.
+    """
+    entries = []
+    for subject in subjects:
+        path = os.path.join(parquet_dir, partition_key(subject))
+        if os.path.exists(path):
+            # COPY from Parquet needs the size of every file
+            entries.append({'url': '%s/%s' % (parquet_s3uri.rstrip('/'), partition_key(subject)),
+                            'mandatory': True, 'meta': {'content_length': os.path.getsize(path)}})
+    if not entries:
+        return None
+    key = '_batches/%s.manifest' % batch
+    os.makedirs(os.path.join(parquet_dir, '_batches'), exist_ok=True)
+    with open(os.path.join(parquet_dir, key), 'w') as f:
+        json.dump({'entries': entries}, f)
+    return '%s/%s' % (parquet_s3uri.rstrip('/'), key)
+
+
+def table_columns(table):
+    """ (column, Redshift type) of a typed feature table, in file order as COPY from Parquet maps them """
+    return [(name, _REDSHIFT_TYPES[str(dtype)]) for name, dtype in table.dtypes.items()]
+
+
+def load_statements(columns, manifest_s3uri, iam_role='default', table=TABLE, existing=()):
+    """
+    SQL loading a batch in one transaction: the rows are copied into a staging table with a single COPY,
+    then replace the rows of the same subjects in table, which is created on the first load. Feature
+    columns are named after the PyRadiomics features, e.g. original_shape_sphericity. Columns missing
+    from the existing columns of table, e.g. after the extraction parameters changed, are added first;
+    rows of the batch leave the columns it lacks NULL.
+    """
+    definition = ', '.join('%s %s' % column for column in columns)
+    names = ', '.join(name for name, _ in columns)
+    stage = '%s_batch' % table
+    role = 'default' if iam_role == 'default' else "'%s'" % iam_role
+    statements = ['CREATE TABLE IF NOT EXISTS %s (%s) DISTSTYLE ALL SORTKEY (subject)' % (table, definition)]
+    if existing:
+        statements += ['ALTER TABLE %s ADD COLUMN %s %s' % (table, name, redshift_type)
+                       for name, redshift_type in columns if name not in existing]
+    statements += ["COMMENT ON COLUMN %s.%s IS '%s'" % (table, name, comment) for name, comment in _COMMENTS.items()]
+    statements += [
+        'CREATE TEMP TABLE %s (%s)' % (stage, definition),
+        "COPY %s FROM '%s' IAM_ROLE %s FORMAT AS PARQUET MANIFEST" % (stage, manifest_s3uri, role),
+        'DELETE FROM %s USING %s WHERE %s.subject = %s.subject' % (table, stage, table, stage),
+        'INSERT INTO %s (%s) SELECT %s FROM %s' % (table, names, names, stage),
+    ]
+    return statements
+
+
+def _split_s3uri(s3uri):
+    bucket, _, key = s3uri.replace('s3://', '').partition('/')
+    return bucket, key
+
+
+def _wait(redshift, statement_id, poll_seconds, what):
+    """ Poll a Data API statement until it finishes, return its description. Raise RuntimeError when it fails """
+    while True:
+        description = redshift.describe_statement(Id=statement_id)
+        if description['Status'] == 'FINISHED':
+            return description
+        if description['Status'] in ('FAILED', 'ABORTED'):
+            raise RuntimeError('%s failed: %s' % (what, description.get('Error', description['Status'])))
+        time.sleep(poll_seconds)
+
+
+def existing_columns(redshift, table=TABLE, cluster=CLUSTER, database=DATABASE, db_user=DB_USER, poll_seconds=1):
+    """ Names of the columns table has in Redshift, empty when it does not exist yet """
+    statement = redshift.execute_statement(
+        ClusterIdentifier=cluster, Database=database, DbUser=db_user,
+        Sql="SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = :table",
+        Parameters=[{'name': 'table', 'value': table}])
+    _wait(redshift, statement['Id'], poll_seconds, 'Reading the columns of %s' % table)
+    names = set()
+    kwargs = {'Id': statement['Id']}
+    while True:
+        result = redshift.get_statement_result(**kwargs)
+        names.update(record[0]['stringValue'] for record in result['Records'])
+        if not result.get('NextToken'):
+            return names
+        kwargs['NextToken'] = result['NextToken']
+
+
+def load_batch(manifest_s3uri, iam_role='default', table=TABLE, cluster=CLUSTER, database=DATABASE,
+               db_user=DB_USER, poll_seconds=5):
+    """
+    Load the partitions listed by a batch manifest into Redshift through the Data API and wait for it.
+    The columns come from the first partition. Raise RuntimeError when the load fails.
+    """
+    s3 = boto3.client('s3')
+    bucket, key = _split_s3uri(manifest_s3uri)
+    entries = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())['entries']
+    bucket, key = _split_s3uri(entries[0]['url'])
+    first = pd.read_parquet(io.BytesIO(s3.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+    redshift = boto3.client('redshift-data')
+    existing = existing_columns(redshift, table, cluster, database, db_user)
+    statement = redshift.batch_execute_statement(
+        ClusterIdentifier=cluster, Database=database, DbUser=db_user,
+        Sqls=load_statements(table_columns(first), manifest_s3uri, iam_role, table, existing))
+    description = _wait(redshift, statement['Id'], poll_seconds, 'Loading %s into %s' % (manifest_s3uri, table))
+    logger.info('Loaded %d subjects of %s into %s in %.1f s'
+                % (len(entries), manifest_s3uri, table, description.get('Duration', 0) / 1e9))
+    return {'table': table, 'subjects': len(entries), 'statement_id': statement['Id']}
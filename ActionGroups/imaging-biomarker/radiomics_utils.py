@@ -1,8 +1,11 @@
 import pandas as pd
-import time
+import copy
+import logging
 import numpy as np
+import nibabel as nib
+import SimpleITK as sitk
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from radiomics import featureextractor
-import boto3
 # import sagemaker
 # from sagemaker.session import Session
 # from sagemaker.feature_store.feature_group import FeatureGroup
@@ -25,6 +28,11 @@ import boto3
 #     sagemaker_featurestore_runtime_client=featurestore_runtime
 # )
 
+logger = logging.getLogger(__name__)
+
+# the extractor every compute_features call uses, built once per process by configure_extractor
+_extractor = None
+
 
 def cast_object_to_string(data_frame):
     for label in data_frame.columns:
@@ -32,25 +40,177 @@ def cast_object_to_string(data_frame):
             data_frame[label] = data_frame[label].astype("str").astype("string")
 
             
-def compute_features(imageName, maskName):
-    extractor = featureextractor.RadiomicsFeatureExtractor()
-    featureVector = extractor.execute(imageName, maskName)
-    
+def crop_to_mask(image, mask, padding=None):
+    """
+    Crop a CT and its mask, nibabel images on the same grid, to the bounding box of the mask
+    plus padding voxels, and return both as SimpleITK images for PyRadiomics.
+
+    By default the padding is 10 voxels when the extractor only uses the original image. Filtered
+    images (LoG, wavelet) depend on voxels far from the tumor, so they get the whole volume, as
+    when PyRadiomics reads the files.
+    """
+    if padding is None:
+        padding = 10 if set(get_extractor().enabledImagetypes) == {'Original'} else max(mask.shape)
+    inside = np.asanyarray(mask.dataobj) > 0
+    if not inside.any():
+        raise Exception('segmentation mask is empty')
+    # extent of the mask along each axis, from its projections
+    extents = [np.flatnonzero(inside.any(axis=tuple(j for j in range(3) if j != i))) for i in range(3)]
+    lower = np.maximum([i[0] - padding for i in extents], 0)
+    upper = np.minimum([i[-1] + padding + 1 for i in extents], mask.shape[:3])
+    box = tuple(slice(i, j) for i, j in zip(lower, upper))
+
+    data = image.dataobj[box]
+    if isinstance(image.dataobj, np.ndarray):
+        # in-memory images hold the stored values, their rescale only lives in the header
+        slope, inter = image.header.get_slope_inter()
+        data = data * (1.0 if slope is None else slope) + (0.0 if inter is None else inter)
+    # float32, the pixel type SimpleITK reads rescaled NIfTI files as; filters differ slightly in float64
+    data = np.asarray(data, dtype=np.float32)
+
+    # NIfTI affines are in RAS, ITK physical space in LPS; the header keeps them
+    # in float32 like the .nii.gz files PyRadiomics used to read
+    affine = np.diag([-1., -1., 1., 1.]).dot(image.header.get_best_affine())
+    spacing = np.array(image.header.get_zooms()[:3], dtype=float)
+    origin = affine.dot(np.append(lower, 1))[:3]
+    cropped = []
+    for array in (data, np.asanyarray(mask.dataobj[box]).astype(np.uint8)):
+        # SimpleITK indexes arrays as z, y, x
+        cropped_image = sitk.GetImageFromArray(np.ascontiguousarray(array.T))
+        cropped_image.SetSpacing(spacing.tolist())
+        cropped_image.SetOrigin(origin.tolist())
+        cropped_image.SetDirection((affine[:3, :3] / spacing).flatten().tolist())
+        cropped.append(cropped_image)
+    return cropped
+
+
+def configure_extractor(params=None, feature_classes=None):
+    """
+    Build the extractor compute_features uses from a PyRadiomics params file or dict (defaults otherwise),
+    with only feature_classes enabled when given, e.g. ['firstorder', 'shape'].
+    """
+    global _extractor
+    extractor = featureextractor.RadiomicsFeatureExtractor(params) if params else featureextractor.RadiomicsFeatureExtractor()
+    if feature_classes:
+        unknown = set(feature_classes) - set(extractor.featureClassNames)
+        if unknown:
+            raise ValueError('Unknown feature classes %s, expected some of %s'
+                             % (', '.join(sorted(unknown)), ', '.join(extractor.featureClassNames)))
+        extractor.disableAllFeatures()
+        for feature_class in feature_classes:
+            extractor.enableFeatureClassByName(feature_class)
+    _extractor = extractor
+    return extractor
+
+
+def get_extractor():
+    if _extractor is None:
+        configure_extractor()
+    return _extractor
+
+
+def _feature_values(featureVector):
     new_dict={}
     for featureName in featureVector.keys():
-        print("Computed %s: %s" % (featureName, featureVector[featureName]))
-        print(type(featureVector[featureName]))
         if isinstance(featureVector[featureName], np.ndarray):
             new_dict[featureName]=float(featureVector[featureName])
         else:
             new_dict[featureName]=featureVector[featureName]
-            
-    df=pd.DataFrame.from_dict(new_dict, orient='index').T
+    return new_dict
+
+
+def compute_features(imageName, maskName, image=None, mask=None):
+    """ Extract features from SimpleITK image and mask when given, otherwise from the imageName and maskName files """
+    featureVector = get_extractor().execute(imageName if image is None else image, maskName if mask is None else mask)
+    df=pd.DataFrame.from_dict(_feature_values(featureVector), orient='index').T
     df=df.convert_dtypes(convert_integer=False)
     df['imageName']=imageName
     df['maskName']=maskName
 
     return df
+
+
+def image_type_parts(extractor):
+    """
+    Split the enabled image types of an extractor into parts that can be extracted independently:
+    one per image type and one per LoG sigma. Shape does not depend on the image type and stays in the first part.
+    """
+    parts = []
+    for image_type, custom in extractor.enabledImagetypes.items():
+        if image_type == 'LoG':
+            sigmas = custom.get('sigma', extractor.settings.get('sigma', []))
+            parts += [{image_type: dict(custom, sigma=[sigma])} for sigma in sigmas]
+        else:
+            parts.append({image_type: custom})
+    return parts
+
+
+def _set_extractor(extractor):
+    global _extractor
+    _extractor = extractor
+
+
+def _extract_part(imageName, maskName, image_types, shape):
+    """ Process pool task: features of one pair for some image types, on the ROI cropped from the files """
+    extractor = get_extractor()
+    if image_types is not None:
+        extractor = copy.deepcopy(extractor)
+        extractor.enabledImagetypes = image_types
+        extractor.enabledFeatures = {name: features for name, features in extractor.enabledFeatures.items()
+                                     if shape or name not in ('shape', 'shape2D')}
+    image, mask = crop_to_mask(nib.load(imageName), nib.load(maskName))
+    return _feature_values(extractor.execute(image, mask))
+
+
+def compute_features_batch(pairs, workers=None, split_image_types=False, on_result=None):
+    """
+    Extract features of many (imageName, maskName) pairs across a process pool into one table,
+    a row per pair in input order; pairs that fail are logged and left out.
+
+    With split_image_types, the image types of a pair (wavelet, every LoG sigma, ...) are extracted
+    in parallel too. on_result(row) is called with every one-row table as soon as its pair is done,
+    to stream results out while the rest are still computing.
+    """
+    extractor = get_extractor()
+    parts = image_type_parts(extractor) if split_image_types else [None]
+    rows = {}
+    pending = {}
+    failed = set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_set_extractor, initargs=(extractor,)) as executor:
+        futures = {executor.submit(_extract_part, imageName, maskName, part, i == 0): (index, i)
+                   for index, (imageName, maskName) in enumerate(pairs) for i, part in enumerate(parts)}
+        for future in as_completed(futures):
+            index, part = futures[future]
+            imageName, maskName = pairs[index]
+            try:
+                values = future.result()
+            except Exception as ex:
+                if index not in failed:
+                    logger.warning('Feature extraction failed for %s: %s' % (imageName, ex))
+                failed.add(index)
+                pending.pop(index, None)
+                continue
+            if index in failed:
+                continue
+            done = pending.setdefault(index, {})
+            done[part] = values
+            if len(done) < len(parts):
+                continue
+            del pending[index]
+            # diagnostics of the first part, features of all of them
+            row = dict(done[0])
+            for i in range(1, len(parts)):
+                row.update((name, value) for name, value in done[i].items() if not name.startswith('diagnostics_'))
+            if split_image_types:
+                row['diagnostics_Configuration_EnabledImageTypes'] = extractor.enabledImagetypes
+            row['imageName'] = imageName
+            row['maskName'] = maskName
+            rows[index] = row
+            if on_result is not None:
+                on_result(pd.DataFrame([row]).convert_dtypes(convert_integer=False))
+
+    df = pd.DataFrame([rows[index] for index in sorted(rows)])
+    return df.convert_dtypes(convert_integer=False)
             
 # def check_feature_group(feature_group_name):
 #     feature_group = FeatureGroup(name=feature_group_name, sagemaker_session=feature_store_session)
@@ -1,14 +1,53 @@
 import json
 import logging
+import random
+import threading
 import time
 import urllib.error
 import urllib.parse
-import urllib.request
-from typing import Any, Dict, Iterator, List
-import xmltodict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from article_parser import iter_articles
+from http_session import HTTPSession, Response
+from literature_index import LiteratureIndex, rank_bm25, tokenize
+from pubmed_cache import LocalDiskStore, S3Store, TieredCache
+from response_assembly import drop_near_duplicates, fit_to_budget
 
 
 logger = logging.getLogger(__name__)
+_token_bucket_lock = threading.Lock()
+_cache_lock = threading.Lock()
+_session_lock = threading.Lock()
+_index_lock = threading.Lock()
+# serializes and uploads the literature index segment off the request path
+_index_writer = ThreadPoolExecutor(max_workers=1)
+
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket that paces requests to a fixed rate.
+    Capacity is one token, so requests are spread out instead of bursting.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
 
 class PubMed():
     """
@@ -25,7 +64,49 @@ class PubMed():
     top_k_results: int = 5
     MAX_QUERY_LENGTH: int = 300
     doc_content_chars_max: int = 10000
+    # agent action group responses are limited to 25KB
+    response_budget_bytes: int = 20000
+    # "repr" keeps the Python list the agent has always received, "json" returns JSON
+    response_format: str = "repr"
+    duplicate_threshold: float = 0.85
+    efetch_batch_size: int = 200
+    max_workers: int = 3
+    rate_limit_headroom: float = 0.95
     email: str = "email@example.com"
+    tool: str = "biomarker-agent"
+    api_key: str = ""
+    http_timeout: float = 10.0
+    _http_session: Optional[HTTPSession] = None
+    _token_bucket: Optional["_TokenBucket"] = None
+    # search results change as PubMed is updated, articles are immutable
+    query_cache_ttl: float = 3600.0
+    article_cache_ttl: float = 30 * 24 * 3600.0
+    cache_max_entries: int = 4096
+    cache_dir: str = ""
+    cache_bucket: str = ""
+    _query_cache: Optional[TieredCache] = None
+    _article_cache: Optional[TieredCache] = None
+    _cache_store: Any = None
+    # BM25 index of every abstract retrieved so far, answering queries it covers
+    local_index: bool = True
+    index_min_coverage: float = 0.75
+    index_max_postings: int = 10000
+    # the segment is rewritten whole, so save it after many new abstracts or a while
+    index_flush_docs: int = 5000
+    index_flush_seconds: float = 900.0
+    index_segment: str = "abstracts.seg"
+    _literature_index: Optional[LiteratureIndex] = None
+    _index_flush: Optional[Future] = None
+    _index_flushed: float = 0.0
+    # over-fetch rerank_candidates ids and keep the top_k_results best by BM25
+    rerank: bool = False
+    rerank_candidates: int = 50
+    # gene expression columns of the clinical_genomic table, matched with a lower weight
+    biomarker_terms: Tuple[str, ...] = (
+        "lrig1", "hpgd", "gdf15", "cdh2", "postn", "vcan", "pdgfra", "vcam1", "cd44", "cd48", "cd4",
+        "lyl1", "spi1", "cd37", "vim", "lmo2", "egr2", "bgn", "col4a1", "col5a1", "col5a2",
+    )
+    biomarker_weight: float = 0.3
 
 
     
@@ -44,33 +125,91 @@ class PubMed():
                     "Summary": result["Summary"]
                 })
 
-            return (
-                docs
-                if docs
-                else "No good PubMed Result was found"
-            )
+            if not docs:
+                return "No good PubMed Result was found"
+            return self._assemble(docs)
         except Exception as ex:
             return f"PubMed exception: {ex}"
             
+    def _assemble(self, docs: List[dict]) -> Any:
+        """
+        Drop near-duplicate abstracts and shorten summaries at sentence
+        boundaries so the serialized response stays within the byte budget.
+        """
+        docs, duplicates = drop_near_duplicates(docs, self.duplicate_threshold)
+        serialize = json.dumps if self.response_format == "json" else str
+        # list brackets and separators, plus the JSON envelope
+        envelope = 2 * len(docs) + 64
+        docs, omitted = fit_to_budget(
+            docs,
+            self.response_budget_bytes - envelope,
+            self.doc_content_chars_max,
+            serialize,
+        )
+        if duplicates or omitted:
+            logger.info(
+                f"Response: {len(docs)} articles, {duplicates} near duplicates "
+                f"and {omitted} over the {self.response_budget_bytes} byte budget left out"
+            )
+        if self.response_format == "json":
+            return json.dumps(
+                {"articles": docs, "duplicates_removed": duplicates, "omitted": omitted}
+            )
+        return docs
+
     def lazy_load(self, query: str) -> Iterator[dict]:
         """
         Search PubMed for documents matching the query.
         Return an iterator of dictionaries containing the document metadata.
         """
 
-        url = (
-            self.base_url_esearch
-            + "db=pubmed&term="
-            + str({urllib.parse.quote(query)})
-            + f"&retmode=json&retmax={self.top_k_results}&usehistory=y"
-        )
-        result = urllib.request.urlopen(url)
-        text = result.read().decode("utf-8")
-        json_text = json.loads(text)
+        query_cache, article_cache = self._caches()
+        retmax = max(self.rerank_candidates, self.top_k_results) if self.rerank else self.top_k_results
+        # PubMed search is case insensitive, so is the query cache
+        query_key = f"{retmax}:{' '.join(query.lower().split())}"
+        webenv = ""
+        uids = query_cache.get(query_key)
+        if uids is None and self.local_index:
+            local = self.search_local(query)
+            if local is not None:
+                yield from local
+                return
+        if uids is None:
+            url = (
+                self.base_url_esearch
+                + "db=pubmed&"
+                + urllib.parse.urlencode({"term": query})
+                + f"&retmode=json&retmax={retmax}&usehistory=y"
+            )
+            with self._urlopen(url) as result:
+                text = result.read().decode("utf-8")
+            json_text = json.loads(text)
 
-        webenv = json_text["esearchresult"]["webenv"]
-        for uid in json_text["esearchresult"]["idlist"]:
-            yield self.retrieve_article(uid, webenv)
+            webenv = json_text["esearchresult"]["webenv"]
+            uids = json_text["esearchresult"]["idlist"]
+            query_cache.put(query_key, uids)
+
+        articles = article_cache.get_many(uids)
+        missing = [uid for uid in uids if uid not in articles]
+        # one efetch per batch of ids instead of one per article
+        batches = [
+            missing[start : start + self.efetch_batch_size]
+            for start in range(0, len(missing), self.efetch_batch_size)
+        ]
+        for fetched in self._fetch_batches(batches, webenv):
+            fetched = {article["uid"]: article for article in fetched}
+            article_cache.put_many(fetched)
+            articles.update(fetched)
+        logger.info(json.dumps([query_cache.stats(), article_cache.stats()]))
+        if self._http_session is not None:
+            logger.info(f"E-utilities: {json.dumps(self._http_session.stats())}")
+        if self.local_index:
+            self._index_articles([articles[uid] for uid in uids if uid in articles])
+
+        ranked = [articles[uid] for uid in uids if uid in articles]
+        if self.rerank:
+            ranked = self.rerank_articles(query, ranked)
+        yield from ranked
 
     def load(self, query: str) -> List[dict]:
         """
@@ -81,75 +220,190 @@ class PubMed():
         # return list(self.lazy_load(query))
         return data
 
-    def retrieve_article(self, uid: str, webenv: str) -> dict:
-        url = (
-            self.base_url_efetch
-            + "db=pubmed&retmode=xml&id="
-            + uid
-            + "&webenv="
-            + webenv
+    def _fetch_batches(
+        self, batches: List[List[str]], webenv: str
+    ) -> Iterator[List[dict]]:
+        """
+        Retrieve several efetch batches concurrently, yielding them in order.
+        The shared token bucket keeps the threads within the NCBI rate limit.
+        """
+        if len(batches) <= 1:
+            yield from (self.retrieve_articles(batch, webenv) for batch in batches)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(
+                lambda batch: self.retrieve_articles(batch, webenv), batches
+            )
+
+    def rerank_articles(self, query: str, articles: List[dict]) -> List[dict]:
+        """
+        Order search candidates by BM25 against the query, with the known
+        biomarker genes as extra low-weight terms, and keep top_k_results.
+        """
+        start = time.perf_counter()
+        weights = dict.fromkeys(self.biomarker_terms, self.biomarker_weight)
+        weights.update(dict.fromkeys(tokenize(query), 1.0))
+        ranked = rank_bm25(articles, weights)[: self.top_k_results]
+        logger.info(
+            f"Reranked {len(articles)} candidates in {(time.perf_counter() - start) * 1000:.2f} ms"
+        )
+        return [article for article, _ in ranked]
+
+    def search_local(self, query: str) -> Optional[List[dict]]:
+        """
+        Answer from the index of abstracts retrieved earlier, reranked like PubMed
+        results when rerank is on. Return None on a miss, when fewer than
+        top_k_results articles cover the query.
+        """
+        index = self._index()
+        start = time.perf_counter()
+        # results are already ranked by BM25, so the reranker only needs a few spare candidates
+        k = 2 * self.top_k_results if self.rerank else self.top_k_results
+        results = index.search(
+            query,
+            k,
+            self.index_min_coverage,
+            self.index_max_postings,
+        )
+        logger.info(
+            f"Local index: {len(results)} of {k} results "
+            f"from {len(index)} abstracts in {(time.perf_counter() - start) * 1000:.2f} ms"
+        )
+        if len(results) < self.top_k_results:
+            return None
+        articles = [article for article, _ in results]
+        if self.rerank:
+            articles = self.rerank_articles(query, articles)
+        return articles
+
+    def _index(self) -> LiteratureIndex:
+        with _index_lock:
+            if self._literature_index is None:
+                self._caches()
+                index = None
+                if self._cache_store is not None:
+                    try:
+                        data = self._cache_store.read_blob(self.index_segment)
+                        if data:
+                            index = LiteratureIndex.from_bytes(data)
+                    except Exception as ex:
+                        logger.warning(f"Literature index load failed: {ex}")
+                self._literature_index = index or LiteratureIndex()
+                self._index_flushed = time.monotonic()
+            return self._literature_index
+
+    def _index_articles(self, articles: List[dict]) -> None:
+        index = self._index()
+        with _index_lock:
+            index.add(articles)
+            if self._cache_store is None or not index.added:
+                return
+            if (
+                index.added < self.index_flush_docs
+                and time.monotonic() - self._index_flushed < self.index_flush_seconds
+            ):
+                return
+            if self._index_flush is not None and not self._index_flush.done():
+                return
+            # write the whole segment once enough new abstracts have accumulated or the last
+            # save is old enough, in the background: Lambda freezes the thread after the
+            # response and resumes it with the next invocation, so no request waits for it
+            self._index_flushed = time.monotonic()
+            self._index_flush = _index_writer.submit(self._flush_index, index)
+
+    def _flush_index(self, index: LiteratureIndex) -> None:
+        start = time.perf_counter()
+        with _index_lock:
+            data = index.to_bytes()
+        try:
+            self._cache_store.write_blob(self.index_segment, data)
+        except Exception as ex:
+            logger.warning(f"Literature index save failed: {ex}")
+            return
+        logger.info(
+            f"Literature index: saved {len(index)} abstracts, {len(data)} bytes "
+            f"in {(time.perf_counter() - start) * 1000:.2f} ms"
         )
 
+    def _caches(self) -> Tuple[TieredCache, TieredCache]:
+        with _cache_lock:
+            if self._query_cache is None:
+                if self.cache_bucket:
+                    self._cache_store = S3Store(self.cache_bucket)
+                elif self.cache_dir:
+                    self._cache_store = LocalDiskStore(self.cache_dir)
+                self._query_cache = TieredCache(
+                    "query", self.query_cache_ttl, self.cache_max_entries, self._cache_store
+                )
+                self._article_cache = TieredCache(
+                    "article", self.article_cache_ttl, self.cache_max_entries, self._cache_store
+                )
+            return self._query_cache, self._article_cache
+
+    def _rate_limiter(self) -> "_TokenBucket":
+        with _token_bucket_lock:
+            if self._token_bucket is None:
+                # NCBI allows 3 requests per second, or 10 with an API key,
+                # keep some headroom so network jitter cannot bunch requests over it
+                rate = 10.0 if self.api_key else 3.0
+                self._token_bucket = _TokenBucket(rate * self.rate_limit_headroom)
+            return self._token_bucket
+
+    def _session(self) -> HTTPSession:
+        with _session_lock:
+            if self._http_session is None:
+                self._http_session = HTTPSession(
+                    timeout=self.http_timeout, max_idle=self.max_workers + 1
+                )
+            return self._http_session
+
+    def _urlopen(self, url: str) -> Response:
+        """Open url once a rate limit token is available, retrying 429s."""
+        # NCBI asks every E-utilities client to identify itself
+        params = {"tool": self.tool, "email": self.email}
+        if self.api_key:
+            params["api_key"] = self.api_key
+        url += "&" + urllib.parse.urlencode(params)
         retry = 0
         while True:
-            try:
-                result = urllib.request.urlopen(url)
-                break
-            except urllib.error.HTTPError as e:
-                if e.code == 429 and retry < self.max_retry:
-                    # Too Many Requests errors
-                    # wait for an exponentially increasing amount of time
-                    logger.warning( 
-                        f"Too Many Requests, "
-                        f"waiting for {self.sleep_time:.2f} seconds..."
-                    )
-                    time.sleep(self.sleep_time)
-                    self.sleep_time *= 2
-                    retry += 1
-                else:
-                    raise e
-
-        xml_text = result.read().decode("utf-8")
-        text_dict = xmltodict.parse(xml_text)
-        return self._parse_article(uid, text_dict)
-
-    def _parse_article(self, uid: str, text_dict: dict) -> dict:
-        try:
-            ar = text_dict["PubmedArticleSet"]["PubmedArticle"]["MedlineCitation"][
-                "Article"
-            ]
-        except KeyError:
-            ar = text_dict["PubmedArticleSet"]["PubmedBookArticle"]["BookDocument"]
-        abstract_text = ar.get("Abstract", {}).get("AbstractText", [])
-        summaries = [
-            f"{txt['@Label']}: {txt['#text']}"
-            for txt in abstract_text
-            if "#text" in txt and "@Label" in txt
-        ]
-        summary = (
-            "\n".join(summaries)
-            if summaries
-            else (
-                abstract_text
-                if isinstance(abstract_text, str)
-                else (
-                    "\n".join(str(value) for value in abstract_text.values())
-                    if isinstance(abstract_text, dict)
-                    else "No abstract available"
+            self._rate_limiter().acquire()
+            response = self._session().get(url)
+            if response.status < 400:
+                return response
+            # read the error body so the connection can be reused
+            response.read()
+            if response.status == 429 and retry < self.max_retry:
+                # Too Many Requests errors
+                # back off with full jitter, the delay only grows for this request
+                delay = random.uniform(0, self.sleep_time * 2**retry)
+                logger.warning(
+                    f"Too Many Requests, "
+                    f"waiting for {delay:.2f} seconds..."
                 )
-            )
-        )
-        a_d = ar.get("ArticleDate", {})
-        pub_date = "-".join(
-            [a_d.get("Year", ""), a_d.get("Month", ""), a_d.get("Day", "")]
+                time.sleep(delay)
+                retry += 1
+            else:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, None
+                )
+
+    def retrieve_article(self, uid: str, webenv: str) -> dict:
+        return self.retrieve_articles([uid], webenv)[0]
+
+    def retrieve_articles(self, uids: List[str], webenv: str) -> List[dict]:
+        """
+        Fetch several articles with a single efetch call.
+        Return the parsed articles in the order of uids.
+        """
+        url = (
+            self.base_url_efetch
+            + "db=pubmed&retmode=xml&id="
+            + ",".join(uids)
         )
+        if webenv:
+            url += "&webenv=" + webenv
 
-        return {
-            "uid": uid,
-            "Title": ar.get("ArticleTitle", ""),
-            "Published": pub_date,
-            "Copyright Information": ar.get("Abstract", {}).get(
-                "CopyrightInformation", ""
-            ),
-            "Summary": summary,
-        }
+        # parse while the body streams in, keeping only the fields we return
+        with self._urlopen(url) as result:
+            articles = {article["uid"]: article for article in iter_articles(result)}
+        return [articles[uid] for uid in uids if uid in articles]
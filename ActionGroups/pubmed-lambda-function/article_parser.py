@@ -0,0 +1,164 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from xml.parsers import expat
+
+
+# element paths below PubmedArticle / PubmedBookArticle whose text we keep
+_FIELDS: Dict[Tuple[str, ...], str] = {
+    ("MedlineCitation", "PMID"): "uid",
+    ("MedlineCitation", "Article", "ArticleTitle"): "Title",
+    ("MedlineCitation", "Article", "Abstract", "AbstractText"): "AbstractText",
+    ("MedlineCitation", "Article", "Abstract", "CopyrightInformation"): "Copyright Information",
+    ("MedlineCitation", "Article", "ArticleDate", "Year"): "Year",
+    ("MedlineCitation", "Article", "ArticleDate", "Month"): "Month",
+    ("MedlineCitation", "Article", "ArticleDate", "Day"): "Day",
+    ("BookDocument", "PMID"): "uid",
+    ("BookDocument", "ArticleTitle"): "Title",
+    ("BookDocument", "Abstract", "AbstractText"): "AbstractText",
+    ("BookDocument", "Abstract", "CopyrightInformation"): "Copyright Information",
+}
+# MeSH descriptors, only extracted on request since the agent never shows them
+_MESH_FIELDS: Dict[Tuple[str, ...], str] = {
+    ("MedlineCitation", "MeshHeadingList", "MeshHeading", "DescriptorName"): "MeSH",
+}
+# lists of fields that repeat within one article
+_REPEATED = ("AbstractText", "MeSH")
+_ARTICLE_ELEMENTS = ("PubmedArticle", "PubmedBookArticle")
+# update files list the PMIDs withdrawn since the baseline
+_DELETE_ELEMENT = "DeleteCitation"
+# summary of articles without an abstract
+NO_ABSTRACT = "No abstract available"
+
+
+def build_article(fields: Dict[str, Any]) -> dict:
+    """
+    Turn the extracted fields of one article into the document the agent sees.
+    Labelled abstract sections are written as "LABEL: text", one per line.
+    """
+    sections: List[Tuple[Optional[str], str]] = fields.get("AbstractText", [])
+    labelled = [f"{label}: {text}" for label, text in sections if label and text]
+    if labelled:
+        summary = "\n".join(labelled)
+    elif sections:
+        summary = "\n".join(text for _, text in sections)
+    else:
+        summary = NO_ABSTRACT
+    pub_date = "-".join(
+        [fields.get("Year", ""), fields.get("Month", ""), fields.get("Day", "")]
+    )
+    article = {
+        "uid": fields.get("uid", ""),
+        "Title": fields.get("Title", ""),
+        "Published": pub_date,
+        "Copyright Information": fields.get("Copyright Information", ""),
+        "Summary": summary,
+    }
+    if "MeSH" in fields:
+        article["MeSH"] = fields["MeSH"]
+    return article
+
+
+class ArticleParser:
+    """
+    Incremental expat parser for PubmedArticleSet XML (efetch responses and baseline files).
+
+    Only the text of the elements in _FIELDS is kept (plus MeSH descriptors
+    when mesh is set); authors, references and the rest of each record are
+    skipped as they stream past, so memory stays bounded by one article
+    whatever the payload size. PMIDs listed under DeleteCitation in update
+    files are passed to on_delete.
+    """
+
+    def __init__(
+        self,
+        on_article: Callable[[dict], None],
+        mesh: bool = False,
+        on_delete: Optional[Callable[[str], None]] = None,
+    ):
+        self.on_article = on_article
+        self.on_delete = on_delete
+        self._field_paths = {**_FIELDS, **_MESH_FIELDS} if mesh else _FIELDS
+        self._max_depth = max(len(path) for path in self._field_paths) + 2
+        self._deleting = False
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        self._parser.CharacterDataHandler = self._characters
+        self._path: List[str] = []
+        self._fields: Optional[Dict[str, Any]] = None
+        self._capture: Optional[str] = None
+        self._capture_depth = 0
+        self._label: Optional[str] = None
+        self._text: List[str] = []
+
+    def feed(self, data: bytes) -> None:
+        self._parser.Parse(data, False)
+
+    def close(self) -> None:
+        self._parser.Parse(b"", True)
+
+    def _start(self, name: str, attrs: Dict[str, str]) -> None:
+        self._path.append(name)
+        depth = len(self._path)
+        if self._capture is not None:
+            # inline markup such as <i> or <sup> inside a captured element
+            return
+        if depth == 2 and name in _ARTICLE_ELEMENTS:
+            self._fields = {}
+        elif depth == 2 and name == _DELETE_ELEMENT:
+            self._deleting = True
+        elif self._deleting and name == "PMID":
+            self._capture = "PMID"
+            self._capture_depth = depth
+            self._text = []
+        elif self._fields is not None and 2 < depth <= self._max_depth:
+            field = self._field_paths.get(tuple(self._path[2:]))
+            if field is not None:
+                self._capture = field
+                self._capture_depth = depth
+                self._label = attrs.get("Label")
+                self._text = []
+
+    def _characters(self, data: str) -> None:
+        if self._capture is not None:
+            self._text.append(data)
+
+    def _end(self, name: str) -> None:
+        depth = len(self._path)
+        self._path.pop()
+        if self._capture is not None and depth == self._capture_depth:
+            text = "".join(self._text).strip()
+            if self._deleting:
+                if self.on_delete is not None:
+                    self.on_delete(text)
+            elif self._capture == "AbstractText":
+                self._fields.setdefault("AbstractText", []).append((self._label, text))
+            elif self._capture in _REPEATED:
+                self._fields.setdefault(self._capture, []).append(text)
+            else:
+                # keep the first occurrence, e.g. the electronic ArticleDate
+                self._fields.setdefault(self._capture, text)
+            self._capture = None
+        elif depth == 2 and self._fields is not None:
+            self.on_article(build_article(self._fields))
+            self._fields = None
+        elif depth == 2:
+            self._deleting = False
+
+
+def iter_articles(stream: Any, chunk_size: int = 64 * 1024) -> Iterator[dict]:
+    """
+    Parse articles from a binary file-like object (an HTTP response, a gzip file)
+    chunk by chunk, yielding each one as soon as its closing tag is read.
+    """
+    articles: List[dict] = []
+    parser = ArticleParser(articles.append)
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        parser.feed(chunk)
+        yield from articles
+        articles.clear()
+    parser.close()
+    yield from articles
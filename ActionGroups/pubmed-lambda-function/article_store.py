@@ -0,0 +1,270 @@
+import heapq
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+# string columns of the store; uid is kept separately as a uint32 array
+COLUMNS = ("title", "date", "abstract", "mesh")
+_ARTICLE_FIELDS = {"title": "Title", "date": "Published", "abstract": "Summary"}
+# MeSH descriptors of one article are joined with the ASCII unit separator
+_MESH_SEPARATOR = "\x1f"
+MANIFEST = "manifest.json"
+# values read or written at a time when streaming array files
+_CHUNK = 1 << 16
+# parts (three open files each) or runs merged at once, well below the usual limit of 1024 open files
+MAX_FAN_IN = 256
+
+
+def _array(typecode: str, path: str) -> array:
+    values = array(typecode)
+    with open(path, "rb") as f:
+        values.frombytes(f.read())
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def _stream(typecode: str, path: str) -> Iterator[int]:
+    """ The values of an array file, read a chunk at a time """
+    size = array(typecode).itemsize * _CHUNK
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(size)
+            if not data:
+                return
+            values = array(typecode)
+            values.frombytes(data)
+            if sys.byteorder == "big":
+                values.byteswap()
+            yield from values
+
+
+def _write_array(values: array, path: str) -> None:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    with open(path, "wb") as f:
+        values.tofile(f)
+
+
+class _ArrayWriter:
+    """ Appends values to an array file a chunk at a time """
+
+    def __init__(self, typecode: str, path: str):
+        self.values = array(typecode)
+        self.file = open(path, "wb")
+
+    def append(self, value: int) -> None:
+        self.values.append(value)
+        if len(self.values) >= _CHUNK:
+            self.flush()
+
+    def flush(self) -> None:
+        if sys.byteorder == "big":
+            self.values.byteswap()
+        self.values.tofile(self.file)
+        del self.values[:]
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+class PartWriter:
+    """
+    Writes the articles of one input file as a part of the store.
+
+    Every string column is appended to its own .bin file as UTF-8 while
+    the articles stream in, with the end offset of each value collected
+    in a uint64 .off array; only the offsets are held in memory. On close the
+    uids are also written sorted, with their rows, for build_index to merge.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.uids = array("I")
+        self.deleted = array("I")
+        self._files = {name: open(os.path.join(directory, f"{name}.bin"), "wb") for name in COLUMNS}
+        self._offsets = {name: array("Q") for name in COLUMNS}
+        self._sizes = dict.fromkeys(COLUMNS, 0)
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def add(self, article: dict) -> None:
+        self.uids.append(int(article["uid"]))
+        values = {name: article.get(field, "") for name, field in _ARTICLE_FIELDS.items()}
+        values["mesh"] = _MESH_SEPARATOR.join(article.get("MeSH", []))
+        for name in COLUMNS:
+            data = values[name].encode("utf-8")
+            self._files[name].write(data)
+            self._sizes[name] += len(data)
+            self._offsets[name].append(self._sizes[name])
+
+    def delete(self, uid: str) -> None:
+        self.deleted.append(int(uid))
+
+    def close(self) -> None:
+        for name in COLUMNS:
+            self._files[name].close()
+            _write_array(self._offsets[name], os.path.join(self.directory, f"{name}.off"))
+        _write_array(self.uids, os.path.join(self.directory, "uid.u32"))
+        _write_array(array("I", sorted(self.deleted)), os.path.join(self.directory, "deleted.u32"))
+        # sorted is stable, so a uid repeated within the file keeps its last row last
+        rows = sorted(range(len(self.uids)), key=self.uids.__getitem__)
+        _write_array(array("I", (self.uids[row] for row in rows)), os.path.join(self.directory, "uid.sorted.u32"))
+        _write_array(array("I", rows), os.path.join(self.directory, "row.sorted.u32"))
+
+
+def _part_entries(directory: str, part_number: int) -> Iterator[Tuple[int, int, int, int]]:
+    """ (uid, part number, kind, row) of a part in uid order, kind 0 for a record and 1 for a deletion """
+    records = zip(_stream("I", os.path.join(directory, "uid.sorted.u32")),
+                  _stream("I", os.path.join(directory, "row.sorted.u32")))
+    deletions = _stream("I", os.path.join(directory, "deleted.u32"))
+    return heapq.merge(
+        ((uid, part_number, 0, row) for uid, row in records),
+        ((uid, part_number, 1, 0) for uid in deletions),
+    )
+
+
+def _run_entries(path: str) -> Iterator[Tuple[int, int, int, int]]:
+    """ The entries of an intermediate run, stored as four uint32 values each """
+    values = _stream("I", path)
+    return zip(values, values, values, values)
+
+
+def _last_entries(entries: Iterable[Tuple[int, int, int, int]]) -> Iterator[Tuple[int, int, int, int]]:
+    """ The last entry of every uid; entries of a uid are in file order, the records of a file before its deletions """
+    for _, group in groupby(entries, key=itemgetter(0)):
+        *_, last = group
+        yield last
+
+
+def build_index(path: str, parts: List[str], max_fan_in: int = MAX_FAN_IN) -> int:
+    """
+    Write the uid index over the parts, in input file order: a record in a later
+    update file replaces the earlier one and DeleteCitation entries drop it.
+    The index is three parallel arrays sorted by uid: uid, part number and row.
+
+    The uid sorted entries of the parts are merged as streams, so memory stays
+    constant however many articles the store holds. At most max_fan_in parts are
+    open at once: beyond that, consecutive parts are first merged into runs keeping
+    the last entry of every uid, deletions included, then the runs are merged.
+    """
+    sources: List[Callable[[], Iterator[Tuple[int, int, int, int]]]] = [
+        partial(_part_entries, os.path.join(path, part), part_number) for part_number, part in enumerate(parts)
+    ]
+    runs = []
+    try:
+        while len(sources) > max_fan_in:
+            merged = []
+            for start in range(0, len(sources), max_fan_in):
+                run = os.path.join(path, f"_run{len(runs)}.u32")
+                writer = _ArrayWriter("I", run)
+                for entry in _last_entries(heapq.merge(*(source() for source in sources[start : start + max_fan_in]))):
+                    for value in entry:
+                        writer.append(value)
+                writer.close()
+                runs.append(run)
+                merged.append(partial(_run_entries, run))
+            sources = merged
+
+        columns = [
+            _ArrayWriter("I", os.path.join(path, "index.uid.u32")),
+            _ArrayWriter("H", os.path.join(path, "index.part.u16")),
+            _ArrayWriter("I", os.path.join(path, "index.row.u32")),
+        ]
+        count = 0
+        for uid, part_number, deleted, row in _last_entries(heapq.merge(*(source() for source in sources))):
+            if not deleted:
+                for writer, value in zip(columns, (uid, part_number, row)):
+                    writer.append(value)
+                count += 1
+        for writer in columns:
+            writer.close()
+    finally:
+        for run in runs:
+            os.remove(run)
+    with open(os.path.join(path, MANIFEST), "w") as f:
+        json.dump({"parts": parts, "columns": ["uid", *COLUMNS], "articles": count}, f)
+    return count
+
+
+class _Part:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.offsets = {name: _array("Q", os.path.join(directory, f"{name}.off")) for name in COLUMNS}
+        self._maps: Dict[str, mmap.mmap] = {}
+
+    def value(self, name: str, row: int) -> str:
+        data = self._maps.get(name)
+        if data is None:
+            with open(os.path.join(self.directory, f"{name}.bin"), "rb") as f:
+                # an empty column cannot be mapped
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+            self._maps[name] = data
+        offsets = self.offsets[name]
+        start = offsets[row - 1] if row else 0
+        return data[start : offsets[row]].decode("utf-8")
+
+
+class ArticleStore:
+    """
+    Read-only access to a store written by baseline_ingest.py.
+
+    Columns are memory mapped, so looking up an article reads only its own
+    values, and scanning one column never touches the others.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.uids = _array("I", os.path.join(path, "index.uid.u32"))
+        self._part_numbers = _array("H", os.path.join(path, "index.part.u16"))
+        self._rows = _array("I", os.path.join(path, "index.row.u32"))
+        self._parts = [_Part(os.path.join(path, part)) for part in self.manifest["parts"]]
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def _locate(self, uid: str) -> Optional[int]:
+        key = int(uid)
+        i = bisect_left(self.uids, key)
+        return i if i < len(self.uids) and self.uids[i] == key else None
+
+    def __contains__(self, uid: str) -> bool:
+        return self._locate(uid) is not None
+
+    def get(self, uid: str) -> Optional[dict]:
+        """
+        Return the article in the shape the PubMed action group uses, or None.
+        """
+        i = self._locate(uid)
+        if i is None:
+            return None
+        part, row = self._parts[self._part_numbers[i]], self._rows[i]
+        mesh = part.value("mesh", row)
+        return {
+            "uid": str(self.uids[i]),
+            "Title": part.value("title", row),
+            "Published": part.value("date", row),
+            "Summary": part.value("abstract", row),
+            "MeSH": mesh.split(_MESH_SEPARATOR) if mesh else [],
+        }
+
+    def column(self, name: str) -> Iterator[Tuple[str, str]]:
+        """
+        Yield (uid, value) for one column in uid order.
+        """
+        for uid, part_number, row in zip(self.uids, self._part_numbers, self._rows):
+            yield str(uid), self._parts[part_number].value(name, row)
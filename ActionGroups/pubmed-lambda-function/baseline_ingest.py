@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Ingest PubMed baseline and update files into a local columnar article store.
+
+    python baseline_ingest.py store/ pubmed24n0001.xml.gz pubmed24n0002.xml.gz ... --workers 8
+
+Each gzip file is streamed through the same expat parser the Lambda uses for
+efetch responses, so memory stays constant per worker whatever the file size.
+Files are written as separate parts in parallel, then one uid index is built
+over them with update files applied in the order given.
+"""
+import argparse
+import gzip
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+from article_parser import ArticleParser
+from article_store import PartWriter, build_index
+
+
+logger = logging.getLogger(__name__)
+
+
+def part_name(path: str) -> str:
+    name = os.path.basename(path)
+    for suffix in (".gz", ".xml"):
+        if name.endswith(suffix):
+            name = name[: -len(suffix)]
+    return name
+
+
+def ingest_file(path: str, output: str, chunk_size: int = 1 << 20) -> Tuple[str, int, int, float]:
+    """
+    Parse one baseline or update file into a part of the store.
+    Return the part name, the number of articles and deletions, and the seconds taken.
+    """
+    start = time.perf_counter()
+    name = part_name(path)
+    writer = PartWriter(os.path.join(output, name))
+    parser = ArticleParser(writer.add, mesh=True, on_delete=writer.delete)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+    parser.close()
+    writer.close()
+    return name, len(writer), len(writer.deleted), time.perf_counter() - start
+
+
+def ingest(paths: List[str], output: str, workers: int = os.cpu_count() or 1) -> dict:
+    """
+    Ingest files in parallel, one process per file, and index the resulting parts.
+    """
+    os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    parts = []
+    articles = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for name, n_articles, n_deleted, seconds in executor.map(ingest_file, paths, [output] * len(paths)):
+            logger.info(f"{name}: {n_articles} articles, {n_deleted} deletions in {seconds:.1f} s "
+                        f"({n_articles / seconds:.0f} articles/s)")
+            parts.append(name)
+            articles += n_articles
+    parsed = time.perf_counter() - start
+    indexed = build_index(output, parts)
+    elapsed = time.perf_counter() - start
+    return {
+        "files": len(paths),
+        "workers": workers,
+        "articles_parsed": articles,
+        "articles_indexed": indexed,
+        "parse_seconds": round(parsed, 2),
+        "total_seconds": round(elapsed, 2),
+        "articles_per_second": round(articles / elapsed) if elapsed else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output", help="Directory of the article store")
+    parser.add_argument("files", nargs="+", help="Baseline and update files (.xml or .xml.gz), oldest first")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Files parsed in parallel (default: CPU count)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    report = ingest(args.files, args.output, args.workers)
+    logger.info(f"Ingested {report['articles_parsed']} articles from {report['files']} files with "
+                f"{report['workers']} workers in {report['total_seconds']} s: "
+                f"{report['articles_per_second']} articles/s, {report['articles_indexed']} in the index")
@@ -0,0 +1,179 @@
+import http.client
+import logging
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+_CONNECTIONS = {"http": http.client.HTTPConnection, "https": http.client.HTTPSConnection}
+
+
+class Response:
+    """
+    File-like response body that decodes gzip as it streams.
+
+    Once the body has been read to the end the connection goes back to the
+    session's pool; closing a response before that discards the connection,
+    since unread bytes would corrupt the next request on it.
+    """
+
+    def __init__(
+        self,
+        session: "HTTPSession",
+        key: Tuple[str, str],
+        connection: http.client.HTTPConnection,
+        response: http.client.HTTPResponse,
+        started: float,
+    ):
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self._session = session
+        self._key = key
+        self._connection: Optional[http.client.HTTPConnection] = connection
+        self._response = response
+        self._started = started
+        self._decoder = (
+            zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if response.getheader("Content-Encoding", "").lower() == "gzip"
+            else None
+        )
+        self._buffer = bytearray()
+        self._received = 0
+        self._decoded = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while self._connection is not None and (size < 0 or len(self._buffer) < size):
+            raw = self._response.read() if size < 0 else self._response.read(max(size, 16384))
+            if not raw:
+                if self._decoder is not None:
+                    self._buffer += self._decoder.flush()
+                self._finish()
+                break
+            self._received += len(raw)
+            data = self._decoder.decompress(raw) if self._decoder is not None else raw
+            self._decoded += len(data)
+            self._buffer += data
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self) -> "Response":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _finish(self) -> None:
+        elapsed = time.perf_counter() - self._started
+        self._session._record(self._received, self._decoded, elapsed)
+        logger.debug(
+            f"{self.status} {self._key[1]} {elapsed * 1000:.0f} ms, "
+            f"{self._received} bytes received, {self._decoded} decoded"
+        )
+        if self._response.will_close:
+            self._connection.close()
+        else:
+            self._session._release(self._key, self._connection)
+        self._connection = None
+
+
+class HTTPSession:
+    """
+    Thread-safe pool of keep-alive connections per host, asking for gzip bodies.
+
+    A request on a pooled connection that the server has meanwhile closed is
+    retried once on a new connection. Counts requests, new connections,
+    bytes received on the wire and after decoding, and request latency.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        max_idle: int = 4,
+        headers: Optional[Dict[str, str]] = None,
+    ):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive", **(headers or {})}
+        self._idle: Dict[Tuple[str, str], List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.bytes_received = 0
+        self.bytes_decoded = 0
+        self.seconds = 0.0
+
+    def get(self, url: str) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = parts.path + (f"?{parts.query}" if parts.query else "")
+        for attempt in range(2):
+            connection, reused = self._acquire(key)
+            started = time.perf_counter()
+            try:
+                connection.request("GET", target, headers=self.headers)
+                response = connection.getresponse()
+            except ConnectionError:
+                connection.close()
+                if reused and attempt == 0:
+                    # the server closed the idle connection, try once on a fresh one
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            return Response(self, key, connection, response, started)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "bytes_received": self.bytes_received,
+                "bytes_decoded": self.bytes_decoded,
+                "mean_latency_ms": round(self.seconds / self.requests * 1000, 1) if self.requests else None,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, key: Tuple[str, str]) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections += 1
+        return _CONNECTIONS[key[0]](key[1], timeout=self.timeout), False
+
+    def _release(self, key: Tuple[str, str], connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _record(self, received: int, decoded: int, seconds: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += received
+            self.bytes_decoded += decoded
+            self.seconds += seconds
@@ -1,10 +1,19 @@
 import json
 import logging
+import os
 logger = logging.getLogger()
 logger.setLevel("INFO")
 
 from PubMed import PubMed
 pubmed = PubMed()
+# optional persistent tier behind the in-process cache, shared across containers when on S3
+pubmed.cache_bucket = os.environ.get("PUBMED_CACHE_BUCKET", "")
+pubmed.cache_dir = os.environ.get("PUBMED_CACHE_DIR", "")
+pubmed.response_format = os.environ.get("PUBMED_RESPONSE_FORMAT", pubmed.response_format)
+pubmed.response_budget_bytes = int(
+    os.environ.get("PUBMED_RESPONSE_BUDGET_BYTES", pubmed.response_budget_bytes)
+)
+pubmed.rerank = os.environ.get("PUBMED_RERANK", "").lower() in ("1", "true", "yes")
 
 
 def lambda_handler(event, context):
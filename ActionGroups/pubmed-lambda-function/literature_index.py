@@ -0,0 +1,289 @@
+import heapq
+import json
+import math
+import re
+import struct
+import sys
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from article_parser import NO_ABSTRACT
+
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the "
+    "their these this to was were which with".split()
+)
+_MAGIC = b"PMBM25\x01"
+_HEADER = struct.Struct("<IQI")
+_LENGTH = struct.Struct("<I")
+_TERM = struct.Struct("<HH")
+_GROUP = struct.Struct("<BI")
+# documents per result kept once the postings budget is spent
+_CANDIDATES = 8
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+def rank_bm25(
+    articles: List[dict],
+    query_weights: Dict[str, float],
+    k1: float = 1.2,
+    b: float = 0.75,
+) -> List[Tuple[dict, float]]:
+    """
+    Score a small set of articles, e.g. one search's candidates, by BM25 with
+    per-term query weights, statistics taken from the articles themselves.
+    Return (article, score) pairs, best first, ties kept in input order.
+    """
+    counts = []
+    lengths = []
+    for article in articles:
+        tokens = tokenize(f"{article.get('Title', '')} {article.get('Summary', '')}")
+        counts.append(Counter(token for token in tokens if token in query_weights))
+        lengths.append(len(tokens))
+    n = len(articles)
+    avgdl = sum(lengths) / n if n else 0.0
+    df = Counter(term for terms in counts for term in terms)
+    idf = {term: math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5)) for term in df}
+    scored = []
+    for article, terms, length in zip(articles, counts, lengths):
+        norm = k1 * (1 - b + b * length / avgdl) if avgdl else k1
+        score = sum(
+            query_weights[term] * idf[term] * tf * (k1 + 1) / (tf + norm)
+            for term, tf in terms.items()
+        )
+        scored.append((article, score))
+    # sorted is stable, so equal scores keep the input (PubMed relevance) order
+    return sorted(scored, key=itemgetter(1), reverse=True)
+
+
+def _doc_ids(data: bytes) -> array:
+    docs = array("I")
+    docs.frombytes(data)
+    if sys.byteorder == "big":
+        docs.byteswap()
+    return docs
+
+
+class LiteratureIndex:
+    """
+    In-memory inverted index with BM25 ranking over the articles PubMed returned.
+
+    Postings are impact ordered: for every term, documents are grouped by their
+    quantized BM25 term frequency component (1-255), the document length
+    normalisation being fixed when a document is added. A query multiplies each
+    group by the term's current idf and accumulates groups from the highest
+    impact down, so the scores that decide the ranking are summed first. With a
+    postings budget, once it is spent only the leading candidates keep being
+    scored, which bounds the dictionary updates spent on very common terms.
+
+    Article documents are kept zlib compressed and only decoded for the results.
+    """
+
+    k1: float = 1.2
+    b: float = 0.75
+
+    def __init__(self):
+        self.uids: List[str] = []
+        self.documents: List[bytes] = []
+        self.total_length = 0
+        self.postings: Dict[str, Dict[int, array]] = {}
+        self._doc_ids: Dict[str, int] = {}
+        # articles added since the index was loaded or last serialized
+        self.added = 0
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._doc_ids
+
+    def add(self, articles: Iterable[dict]) -> int:
+        """
+        Index articles not seen before, return how many were added.
+        Articles without an abstract are left out, their title alone would rank too well.
+        """
+        added = 0
+        for article in articles:
+            uid = article.get("uid")
+            if not uid or uid in self._doc_ids or article.get("Summary", NO_ABSTRACT) == NO_ABSTRACT:
+                continue
+            terms = Counter(tokenize(f"{article.get('Title', '')} {article.get('Summary', '')}"))
+            length = sum(terms.values())
+            doc_id = len(self.uids)
+            self._doc_ids[uid] = doc_id
+            self.uids.append(uid)
+            self.documents.append(zlib.compress(json.dumps(article).encode("utf-8")))
+            self.total_length += length
+            avgdl = self.total_length / len(self.uids)
+            norm = self.k1 * (1 - self.b + self.b * length / avgdl) if avgdl else self.k1
+            for term, tf in terms.items():
+                # tf * (k1 + 1) / (tf + norm), scaled from (0, k1 + 1) to 1..255
+                level = max(1, round(255 * tf / (tf + norm)))
+                groups = self.postings.get(term)
+                if groups is None:
+                    groups = self.postings[term] = {}
+                docs = groups.get(level)
+                if docs is None:
+                    docs = groups[level] = array("I")
+                docs.append(doc_id)
+            added += 1
+        self.added += added
+        return added
+
+    def document(self, doc_id: int) -> dict:
+        return json.loads(zlib.decompress(self.documents[doc_id]))
+
+    def _idf(self, term: str) -> float:
+        groups = self.postings.get(term, {})
+        df = sum(len(docs) for docs in groups.values())
+        n = len(self.uids)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(
+        self,
+        query: str,
+        k: int = 5,
+        min_coverage: float = 0.0,
+        max_postings: Optional[int] = None,
+    ) -> List[Tuple[dict, float]]:
+        """
+        Return up to k (article, score) pairs ranked by BM25.
+
+        Candidates come from the quantized impacts, narrowed to the leading
+        documents after max_postings postings when given, whose scores are then
+        completed by binary search in the remaining blocks; the best 4 * k are
+        decoded and rescored with exact BM25 on their text. min_coverage is
+        the share of the query's idf mass a result must contain, so results that
+        only match the common words of a query are left out.
+        """
+        terms = set(tokenize(query))
+        idf = {term: self._idf(term) for term in terms}
+        blocks = []
+        for term in terms:
+            groups = self.postings.get(term)
+            if groups:
+                weight = idf[term] * (self.k1 + 1) / 255
+                blocks.extend((weight * level, docs) for level, docs in groups.items())
+        blocks.sort(key=itemgetter(0), reverse=True)
+
+        scores: Dict[int, float] = {}
+        get = scores.get
+        budget = sys.maxsize
+        if max_postings is not None and sum(len(docs) for _, docs in blocks) > 2 * max_postings:
+            budget = max_postings
+        candidates = None
+        for impact, docs in blocks:
+            if budget > 0:
+                if len(docs) > budget:
+                    docs, rest = docs[:budget], docs[budget:]
+                else:
+                    rest = None
+                budget -= len(docs)
+                for doc_id in docs:
+                    scores[doc_id] = get(doc_id, 0.0) + impact
+                if budget > 0:
+                    continue
+                # out of budget: keep the leading candidates and only complete their scores
+                candidates = sorted(
+                    doc_id for doc_id, _ in heapq.nlargest(_CANDIDATES * k, scores.items(), key=itemgetter(1))
+                )
+                if rest is None:
+                    continue
+                docs = rest
+            size = len(docs)
+            if size <= 4 * len(candidates):
+                for doc_id in set(candidates).intersection(docs):
+                    scores[doc_id] += impact
+                continue
+            # blocks are sorted by doc id, so look the few candidates up instead of scanning the block
+            i = 0
+            for doc_id in candidates:
+                i = bisect_left(docs, doc_id, i)
+                if i < size and docs[i] == doc_id:
+                    scores[doc_id] += impact
+
+        total = sum(idf.values())
+        avgdl = self.total_length / len(self.uids) if self.uids else 0.0
+        if candidates is not None:
+            scores = {doc_id: scores[doc_id] for doc_id in candidates}
+        results = []
+        for doc_id, _ in heapq.nlargest(4 * k, scores.items(), key=itemgetter(1)):
+            article = self.document(doc_id)
+            tokens = tokenize(f"{article.get('Title', '')} {article.get('Summary', '')}")
+            counts = Counter(token for token in tokens if token in terms)
+            if sum(idf[term] for term in counts) < min_coverage * total:
+                continue
+            norm = self.k1 * (1 - self.b + self.b * len(tokens) / avgdl) if avgdl else self.k1
+            score = sum(idf[term] * tf * (self.k1 + 1) / (tf + norm) for term, tf in counts.items())
+            results.append((article, score))
+        results.sort(key=itemgetter(1), reverse=True)
+        return results[:k]
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize the index as one segment: header, uids, compressed documents, then postings
+        with the raw little-endian doc ids of every impact group.
+        """
+        uids = "\n".join(self.uids).encode("utf-8")
+        parts = [
+            _MAGIC,
+            _HEADER.pack(len(self.uids), self.total_length, len(self.postings)),
+            _LENGTH.pack(len(uids)),
+            uids,
+        ]
+        for blob in self.documents:
+            parts.append(_LENGTH.pack(len(blob)))
+            parts.append(blob)
+        for term, groups in self.postings.items():
+            encoded = term.encode("utf-8")
+            parts.append(_TERM.pack(len(encoded), len(groups)))
+            parts.append(encoded)
+            for level, docs in groups.items():
+                if sys.byteorder == "big":
+                    docs = array("I", docs)
+                    docs.byteswap()
+                parts.append(_GROUP.pack(level, len(docs)))
+                parts.append(docs.tobytes())
+        self.added = 0
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LiteratureIndex":
+        if not data.startswith(_MAGIC):
+            raise ValueError("Not a literature index segment")
+        view = memoryview(data)
+        index = cls()
+        offset = len(_MAGIC)
+        n_docs, index.total_length, n_terms = _HEADER.unpack_from(view, offset)
+        offset += _HEADER.size
+        (size,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        index.uids = bytes(view[offset : offset + size]).decode("utf-8").split("\n") if n_docs else []
+        index._doc_ids = {uid: doc_id for doc_id, uid in enumerate(index.uids)}
+        offset += size
+        for _ in range(n_docs):
+            (size,) = _LENGTH.unpack_from(view, offset)
+            offset += _LENGTH.size
+            index.documents.append(bytes(view[offset : offset + size]))
+            offset += size
+        for _ in range(n_terms):
+            size, n_groups = _TERM.unpack_from(view, offset)
+            offset += _TERM.size
+            term = bytes(view[offset : offset + size]).decode("utf-8")
+            offset += size
+            groups = index.postings[term] = {}
+            for _ in range(n_groups):
+                level, count = _GROUP.unpack_from(view, offset)
+                offset += _GROUP.size
+                groups[level] = _doc_ids(view[offset : offset + 4 * count])
+                offset += 4 * count
+        return index
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(key: str) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class LocalDiskStore:
+    """
+    Persistent tier keeping one JSON file per entry in a directory,
+    e.g. under /tmp, which outlives the process in a warm Lambda container.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, _digest(key) + ".json")
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, entry: dict) -> None:
+        path = self._path(key)
+        # write then rename, so concurrent readers never see a partial file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp, path)
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        path = os.path.join(self.directory, name)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+
+class S3Store:
+    """
+    Persistent tier shared by every Lambda container, one JSON object per entry.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "pubmed-cache/"):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3")
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.prefix + _digest(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return json.loads(obj["Body"].read())
+
+    def put(self, key: str, entry: dict) -> None:
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + _digest(key),
+            Body=json.dumps(entry).encode("utf-8"),
+            ContentType="application/json",
+        )
+
+    def read_blob(self, name: str) -> Optional[bytes]:
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return obj["Body"].read()
+
+    def write_blob(self, name: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data)
+
+
+class TieredCache:
+    """
+    Thread-safe LRU cache with a time to live, optionally backed by a persistent store.
+
+    Lookups try the in-process LRU first, then the store; store hits are copied
+    into the LRU. Expiry times are wall clock timestamps saved with each entry,
+    so they hold across processes sharing a store. Store errors are logged and
+    treated as misses, the cache never fails a search.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        max_entries: int = 1024,
+        store: Optional[Any] = None,
+        max_workers: int = 8,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.store = store
+        self.max_workers = max_workers
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """
+        Return the cached value of every key that is present and fresh.
+        Keys missing from memory are looked up in the store concurrently.
+        """
+        now = time.time()
+        found: Dict[str, Any] = {}
+        missing: List[str] = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[1]
+                    self.memory_hits += 1
+                else:
+                    if entry is not None:
+                        del self._entries[key]
+                    missing.append(key)
+
+        if missing and self.store is not None:
+            for key, entry in zip(missing, self._map_store(self._store_get, missing)):
+                if entry is not None and entry["expires"] > now:
+                    self._remember(key, entry["expires"], entry["value"])
+                    found[key] = entry["value"]
+        misses = sum(key not in found for key in missing)
+        with self._lock:
+            self.store_hits += len(missing) - misses
+            self.misses += misses
+        return found
+
+    def put(self, key: str, value: Any) -> None:
+        self.put_many({key: value})
+
+    def put_many(self, items: Dict[str, Any]) -> None:
+        expires = time.time() + self.ttl
+        for key, value in items.items():
+            self._remember(key, expires, value)
+        if items and self.store is not None:
+            entries = [(key, {"expires": expires, "value": value}) for key, value in items.items()]
+            self._map_store(lambda item: self._store_put(*item), entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            hits = self.memory_hits + self.store_hits
+            return {
+                "cache": self.name,
+                "lookups": lookups,
+                "memory_hits": self.memory_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_ratio": round(hits / lookups, 3) if lookups else None,
+            }
+
+    def _remember(self, key: str, expires: float, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _map_store(self, fn: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+        # store calls are I/O bound (S3 round trips), overlap them
+        if len(items) == 1 or self.max_workers <= 1:
+            return [fn(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+    def _store_get(self, key: str) -> Optional[dict]:
+        try:
+            return self.store.get(f"{self.name}/{key}")
+        except Exception as ex:
+            logger.warning(f"{self.name} cache store read failed: {ex}")
+            return None
+
+    def _store_put(self, key: str, entry: dict) -> None:
+        try:
+            self.store.put(f"{self.name}/{key}", entry)
+        except Exception as ex:
+            logger.warning(f"{self.name} cache store write failed: {ex}")
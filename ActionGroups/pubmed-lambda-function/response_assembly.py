@@ -0,0 +1,104 @@
+import json
+import re
+from typing import Callable, FrozenSet, List, Tuple
+
+from article_parser import NO_ABSTRACT
+
+
+# a sentence ends at ., ! or ? followed by whitespace, or at a line break (labelled sections)
+_SENTENCE_END = re.compile(r"[.!?](?=\s)|\n")
+_WORD = re.compile(r"\w+")
+ELLIPSIS = " ..."
+
+
+def truncate_sentences(text: str, max_chars: int) -> str:
+    """
+    Cut text to at most max_chars, ending on the last complete sentence that fits.
+    Falls back to the last word boundary when not even one sentence fits.
+    """
+    if len(text) <= max_chars:
+        return text
+    limit = max(max_chars - len(ELLIPSIS), 0)
+    end = 0
+    for match in _SENTENCE_END.finditer(text, 0, limit + 1):
+        end = match.end()
+    if not end:
+        end = text.rfind(" ", 0, limit + 1)
+        if end <= 0:
+            end = limit
+    return text[:end].rstrip() + ELLIPSIS
+
+
+def _shingles(text: str, size: int = 3) -> FrozenSet[Tuple[str, ...]]:
+    words = _WORD.findall(text.lower())
+    return frozenset(tuple(words[i : i + size]) for i in range(max(len(words) - size + 1, 1)))
+
+
+def drop_near_duplicates(docs: List[dict], threshold: float = 0.85) -> Tuple[List[dict], int]:
+    """
+    Keep the first of every group of abstracts whose word 3-shingle Jaccard
+    similarity is at least threshold, e.g. an erratum or a conference abstract
+    republished as a paper. Return the kept docs and how many were dropped.
+    """
+    kept: List[dict] = []
+    seen: List[FrozenSet[Tuple[str, ...]]] = []
+    for doc in docs:
+        summary = doc.get("Summary", "")
+        if summary and summary != NO_ABSTRACT:
+            shingles = _shingles(summary)
+            if any(len(shingles & other) >= threshold * len(shingles | other) for other in seen):
+                continue
+            seen.append(shingles)
+        kept.append(doc)
+    return kept, len(docs) - len(kept)
+
+
+def _size(serialize: Callable[[dict], str], doc: dict) -> int:
+    return len(serialize(doc).encode("utf-8"))
+
+
+def fit_to_budget(
+    docs: List[dict],
+    budget_bytes: int,
+    doc_chars_max: int,
+    serialize: Callable[[dict], str] = json.dumps,
+    min_summary_chars: int = 200,
+) -> Tuple[List[dict], int]:
+    """
+    Shorten summaries so the serialized docs fit in budget_bytes overall.
+
+    Every summary is first capped at doc_chars_max. Docs are then filled in
+    rank order, each getting an equal share of the bytes still unspent, so
+    the room short abstracts leave goes to the ones ranked after them. When
+    the budget cannot give every doc min_summary_chars, the shares go to the
+    top ranked docs only, and the first doc that cannot keep that much of its
+    summary is dropped with the rest. Return the docs that fit and how many
+    were left out.
+    """
+    fitted: List[dict] = []
+    remaining = budget_bytes
+    slots = len(docs)
+    if docs:
+        overhead = _size(serialize, dict(docs[0], Summary=""))
+        slots = max(1, min(slots, budget_bytes // (overhead + min_summary_chars)))
+    for i, doc in enumerate(docs):
+        doc = dict(doc, Summary=truncate_sentences(doc.get("Summary", ""), doc_chars_max))
+        share = remaining // max(slots - i, 1)
+        size = _size(serialize, doc)
+        if size > share:
+            # bytes of everything but the summary text, then what is left for it
+            overhead = _size(serialize, dict(doc, Summary=""))
+            room = share - overhead
+            summary = doc["Summary"]
+            while room >= min_summary_chars:
+                doc["Summary"] = truncate_sentences(summary, room)
+                size = _size(serialize, doc)
+                if size <= share:
+                    break
+                # escaped or multi-byte characters take more than one byte each
+                room -= size - share
+            else:
+                break
+        fitted.append(doc)
+        remaining -= size
+    return fitted, len(docs) - len(fitted)
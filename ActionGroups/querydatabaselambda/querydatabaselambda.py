@@ -68,16 +68,20 @@ def refineSQL(sql, question):
     return "No SQL found in response"
 
 def get_schema():
+    # imaging_features is created by the first imaging job that loads radiomic features, join on subject
     sql = """
         SELECT
-            'clinical_genomic' AS table_name,
+            c.relname AS table_name,
             a.attname AS column_name,
             pg_catalog.format_type(a.atttypid, a.atttypmod) AS column_type,
             pg_catalog.col_description(a.attrelid, a.attnum) AS column_comment
         FROM
             pg_catalog.pg_attribute a
+            JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+            JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
         WHERE
-            a.attrelid = 'clinical_genomic'::regclass
+            c.relname IN ('clinical_genomic', 'imaging_features')
+            AND n.nspname = 'public'
             AND a.attnum > 0
             AND NOT a.attisdropped;"""
     
@@ -138,7 +142,8 @@ def extract_table_columns(query):
         table_name = record[0]["stringValue"]
         column_name = record[1]["stringValue"]
         column_type = record[2]["stringValue"]
-        column_comment = record[3]["stringValue"]
+        # columns without a comment come back as isNull
+        column_comment = record[3].get("stringValue")
         column_details = {
             "name": column_name,
             "type": column_type,
@@ -1,45 +1,30 @@
 
 import json
-from lifelines import KaplanMeierFitter,CoxPHFitter
+from lifelines import KaplanMeierFitter
 import plotly.graph_objects as go
 import ast
 import io
-import kaleido
 import boto3
 import os
-import pandas as pd
-from lifelines import CoxPHFitter
+import resampling
+import screening
+import spill_reader
+import uuid
+from cox_service import CoxFittingService, encode_summary
   
 
 
 
-def fit_survival_regression_model(data):
-    """ Fit Cox survival regression model to data and return a data frame """
-    records = data['Records']
-    # Convert the data to a list of lists
-    rows = []
-    for row in records:
-        rows.append([value.get(list(value.keys())[0]) for value in row])
+# Cox summaries larger than this, or cut down to top_k covariates, are also written to S3 in full
+SUMMARY_INLINE_BYTES = 20000
 
-    # Create the DataFrame
-    df = pd.DataFrame(rows)
+# kept across warm invocations so refits reuse parsed datasets and earlier coefficients
+cox_fitting_service = CoxFittingService(penalizer=0.0001)
 
-    # Convert 'Alive' and 'Dead' to 0 and 1, and ensure it's numeric
-    df[0] = df[0].map({False: 0, True: 1})
-    print("lastest version")
-    
-    df_numeric = df.select_dtypes(include='number')
-    
-    df_numeric.columns = range(len(df_numeric.columns))
 
-    
-    
-    print(df_numeric)
-    cph = CoxPHFitter(penalizer=0.0001)
-    
-    cph.fit(df_numeric, duration_col=1, event_col=0)
-    summary = cph.summary
-    return summary
+def fit_survival_regression_model(version, load_columns, covariates=None, cohort_filter=None):
+    """ Fit Cox survival regression model to a cached dataset version and return a data frame """
+    return cox_fitting_service.fit(version, load_columns, covariates=covariates, cohort_filter=cohort_filter)
     
 
 def fit_km(name, durations, event_observed):
@@ -127,6 +112,12 @@ def save_plot(fig,s3_bucket):
     bucket.put_object(Body=img_data, ContentType='image/png', Key=KEY)
     return
 
+def upload_result_s3(result, bucket, key):
+    s3 = boto3.resource('s3')
+    s3object = s3.Object(bucket, key)
+    s3object.put(Body=result.encode('UTF-8'), ContentType='application/json')
+    return s3object
+
 def lambda_handler(event, context):
     agent = event['agent']
     actionGroup = event['actionGroup']
@@ -175,32 +166,93 @@ def lambda_handler(event, context):
                     "body": "The function {} was called successfully!".format(function)
                 }
             }
+        elif function == "estimate_survival_confidence":
+            n_replicates = 1000
+            for param in parameters:
+                if param["name"] == "duration_baseline":
+                    duration_baseline = ast.literal_eval(param["value"])
+                if param["name"] == "event_baseline":
+                    event_baseline = ast.literal_eval(param["value"])
+                if param["name"] == "duration_condition":
+                    duration_condition = ast.literal_eval(param["value"])
+                if param["name"] == "event_condition":
+                    event_condition = ast.literal_eval(param["value"])
+                if param["name"] == "n_replicates":
+                    n_replicates = int(param["value"])
+
+            bootstrap = resampling.bootstrap_survival(duration_baseline, event_baseline, duration_condition, event_condition,
+                                                      n_replicates=n_replicates)
+            permutation = resampling.permutation_logrank(duration_baseline, event_baseline, duration_condition, event_condition,
+                                                         n_permutations=n_replicates)
+            responseBody = {
+                "TEXT": {
+                    "body": json.dumps({"bootstrap": bootstrap, "permutation_logrank": permutation})
+                }
+            }
+        elif function == "screen_biomarkers":
+            quantile = 0.5
+            for param in parameters:
+                if param["name"] == "bucket":
+                    bucket = param["value"]
+                if param["name"] == "key":
+                    key = param["value"]
+                if param["name"] == "quantile":
+                    quantile = float(param["value"])
+            s3 = boto3.client('s3')
+            obj = s3.get_object(Bucket=bucket, Key=key)
+            columns = spill_reader.read_columns(obj['Body'])
+            ranking = screening.screen_biomarkers(columns, quantile=quantile)
+            responseBody = {
+                "TEXT": {
+                    "body": json.dumps(ranking)
+                }
+            }
+        elif function == "fit_survival_regression":
+            bucket = ''
+            key = ''
+            covariates = None
+            cohort_filter = None
+            precision = 4
+            top_k = 10
+            s3 = boto3.client('s3')
+            for param in parameters:
+                if param["name"] == "bucket":
+                    bucket = param["value"]
+                    print(bucket)
+                if param["name"] == "key":
+                    key = param["value"]
+                    print(key)
+                if param["name"] == "covariates":
+                    covariates = ast.literal_eval(param["value"])
+                if param["name"] == "cohort_filter":
+                    cohort_filter = param["value"]
+                if param["name"] == "precision":
+                    precision = int(param["value"])
+                if param["name"] == "top_k":
+                    top_k = int(param["value"])
+            obj = s3.get_object(Bucket=bucket, Key=key)
+            # the ETag changes whenever the object is rewritten, so it identifies the dataset version
+            version = '{}/{}@{}'.format(bucket, key, obj['ETag'])
+            summary = fit_survival_regression_model(version, lambda: spill_reader.read_columns(obj['Body']),
+                                                    covariates, cohort_filter)
+            obj['Body'].close()
+            result = encode_summary(summary, precision=precision, top_k=top_k)
+            if result['omitted'] or len(json.dumps(result)) > SUMMARY_INLINE_BYTES:
+                # the complete, full precision summary goes to S3 and the agent gets a pointer to it
+                summary_key = 'regression/{}.json'.format(uuid.uuid4())
+                upload_result_s3(summary.to_json(orient='split'), os.environ['S3_BUCKET'], summary_key)
+                result['full_summary'] = {'bucket': os.environ['S3_BUCKET'], 'key': summary_key}
+            responseBody =  {
+                "TEXT": {
+                    "body": "The function {} was called successfully! with a response summary as {}".format(function, json.dumps(result))
+                }
+            }
     except Exception as e:
         responseBody = {
             "TEXT": {
                 "body": "An error occurred: {}".format(str(e))
             }
         }
-    
-    if function == "fit_survival_regression":
-        bucket = ''
-        key = ''
-        s3 = boto3.client('s3')
-        for param in parameters:
-            if param["name"] == "bucket":
-                bucket = param["value"]
-                print(bucket)
-            if param["name"] == "key":
-                key = param["value"]
-                print(key)
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        data = json.loads(obj['Body'].read().decode('utf-8'))
-        summary = fit_survival_regression_model(data)
-        responseBody =  {
-            "TEXT": {
-                "body": "The function {} was called successfully! with a response summary as {}".format(function,summary)
-            }
-        }
 
     action_response = {
         'actionGroup': actionGroup,
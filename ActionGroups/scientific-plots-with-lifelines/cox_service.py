@@ -0,0 +1,152 @@
+import ast
+import operator
+import re
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from lifelines import CoxPHFitter
+
+
+_CONDITION = re.compile(r'^\s*(\w+)\s*(==|!=|>=|<=|>|<)\s*(.+?)\s*$')
+_OPERATORS = {'==': operator.eq, '!=': operator.ne, '>=': operator.ge,
+              '<=': operator.le, '>': operator.gt, '<': operator.lt}
+
+
+def _resolve(names, name):
+    """ Match a column name case-insensitively, since Redshift lower-cases result column names """
+    for candidate in names:
+        if str(candidate).lower() == str(name).lower():
+            return candidate
+    raise ValueError(f"Unknown column: {name}")
+
+
+class _Dataset:
+    """ Per-subject design matrix of one dataset version, sorted by duration and event once """
+
+    def __init__(self, columns):
+        names = list(columns)
+        table = pd.DataFrame(columns)
+        # first column is the survival status, second the survival duration
+        self.event_col, self.duration_col = names[0], names[1]
+        # Convert 'Alive' and 'Dead' to 0 and 1, and ensure it's numeric
+        table[self.event_col] = table[self.event_col].map({False: 0, True: 1})
+        self.table = table.sort_values([self.duration_col, self.event_col], kind='mergesort').reset_index(drop=True)
+        # columns holding NULLs are left out of the model
+        numeric = self.table.select_dtypes(include='number').dropna(axis=1)
+        self.covariates = [name for name in numeric.columns if name not in (self.event_col, self.duration_col)]
+        self.fits = OrderedDict()
+
+    def cohort_mask(self, cohort_filter):
+        """ Rows matching conditions such as "age_at_histological_diagnosis > 50 and gender == 'Male'" """
+        mask = np.ones(len(self.table), dtype=bool)
+        if not cohort_filter:
+            return mask
+        for condition in re.split(r'\s+and\s+', cohort_filter.strip(), flags=re.IGNORECASE):
+            match = _CONDITION.match(condition)
+            if not match:
+                raise ValueError(f"Unsupported cohort filter condition: {condition}")
+            name, op, literal = match.groups()
+            try:
+                value = ast.literal_eval(literal)
+            except (ValueError, SyntaxError):
+                value = literal
+            mask &= _OPERATORS[op](self.table[_resolve(self.table.columns, name)], value).to_numpy()
+        return mask
+
+
+class CoxFittingService:
+    """
+    Fits Cox models against cached datasets and warm-starts refits from earlier coefficients.
+
+    A dataset version (e.g. an S3 object and its ETag) is parsed and sorted once. Adding or
+    dropping covariates or narrowing the cohort then reuses that design matrix and starts
+    Newton-Raphson from the closest previous fit instead of from zero, and repeating an
+    identical request returns the cached summary.
+    """
+
+    def __init__(self, penalizer=0.0001, max_datasets=4, max_fits=16):
+        self.penalizer = penalizer
+        self.max_datasets = max_datasets
+        self.max_fits = max_fits
+        self._datasets = OrderedDict()
+
+    def _dataset(self, version, load_columns):
+        if version in self._datasets:
+            self._datasets.move_to_end(version)
+        else:
+            self._datasets[version] = _Dataset(load_columns())
+            if len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+        return self._datasets[version]
+
+    def fit(self, version, load_columns, covariates=None, cohort_filter=None):
+        """
+        Fit a Cox proportional hazards model and return its lifelines summary data frame.
+
+        Args:
+            version (str): Identifies the dataset contents, e.g. bucket, key and ETag.
+            load_columns (callable): Returns the column name to array mapping on a cache miss.
+            covariates (list): Covariate column names, defaults to every numeric column.
+            cohort_filter (str): Conditions joined by 'and' selecting the cohort to fit.
+        """
+        dataset = self._dataset(version, load_columns)
+        if covariates:
+            covariates = [_resolve(dataset.covariates, name) for name in covariates]
+        else:
+            covariates = list(dataset.covariates)
+
+        fit_key = (tuple(covariates), (cohort_filter or '').strip())
+        if fit_key in dataset.fits:
+            dataset.fits.move_to_end(fit_key)
+            return dataset.fits[fit_key][1]
+
+        df = dataset.table.loc[dataset.cohort_mask(cohort_filter),
+                               [dataset.duration_col, dataset.event_col] + covariates]
+        initial_point = None
+        if dataset.fits:
+            # closest previous fit: most covariates in common, then same cohort, then most recent
+            previous = max(reversed(dataset.fits.items()),
+                           key=lambda fit: (fit[1][0].index.intersection(covariates).size, fit[0][1] == fit_key[1]))[1][0]
+            if previous.index.intersection(covariates).size:
+                # lifelines iterates on standardized covariates, so scale the coefficients to match
+                initial_point = (previous.reindex(covariates).fillna(0.0) * df[covariates].std(0)).to_numpy()
+
+        cph = CoxPHFitter(penalizer=self.penalizer)
+        cph.fit(df, duration_col=dataset.duration_col, event_col=dataset.event_col, initial_point=initial_point)
+        dataset.fits[fit_key] = (cph.params_, cph.summary)
+        if len(dataset.fits) > self.max_fits:
+            dataset.fits.popitem(last=False)
+        return cph.summary
+
+
+SUMMARY_FIELDS = ['covariate', 'coef', 'hr', 'hr_lower', 'hr_upper', 'p']
+
+
+def _round(value, precision):
+    """ Round to significant digits, so small p-values keep their magnitude """
+    return float(f'{value:.{precision}g}') if np.isfinite(value) else None
+
+
+def encode_summary(summary, precision=4, top_k=None):
+    """
+    Encode a lifelines Cox summary as a compact table of coef, hazard ratio, its CI and p per covariate.
+
+    Args:
+        summary (DataFrame): CoxPHFitter.summary.
+        precision (int): Significant digits kept for every number.
+        top_k (int): Keep only the k most significant covariates, all of them if None.
+
+    Returns:
+        dict: 'columns' naming the fields, 'rows' with one list per covariate ordered by p-value,
+            and the number of covariates left out by top_k.
+    """
+    hr_lower = next(name for name in summary.columns if name.startswith('exp(coef) lower'))
+    hr_upper = next(name for name in summary.columns if name.startswith('exp(coef) upper'))
+    ranked = summary.sort_values('p', kind='mergesort')
+    if top_k is not None:
+        ranked = ranked.head(top_k)
+    rows = [[str(covariate)] + [_round(value, precision) for value in values]
+            for covariate, values in zip(ranked.index,
+                                         ranked[['coef', 'exp(coef)', hr_lower, hr_upper, 'p']].to_numpy())]
+    return {'columns': SUMMARY_FIELDS, 'rows': rows, 'omitted': len(summary) - len(rows)}
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+import argparse
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+
+import numpy as np
+
+
+# keep Newton steps and log hazard ratios bounded when a replicate has no events in one group
+_MAX_STEP = 1.0
+_MAX_LOG_HR = 20.0
+
+
+class SurvivalData:
+    """ Survival samples sorted by duration once, so every replicate or biomarker split shares one time index """
+
+    def __init__(self, durations, events, condition):
+        durations = np.asarray(durations, dtype=float)
+        events = np.asarray(events, dtype=float)
+        condition = np.asarray(condition, dtype=float)
+        if not len(durations) == len(events) == len(condition):
+            raise ValueError('durations, events and condition must have the same length')
+
+        order = np.argsort(durations, kind='stable')
+        self.order = order
+        self.durations = durations[order]
+        self.events = events[order]
+        self.condition = condition[order]
+        self.n = len(self.durations)
+        # unique event times and where each one starts in the sorted arrays
+        self.times, self.starts = np.unique(self.durations, return_index=True)
+        # sorted positions of each group, used to resample within the group
+        self.strata = [np.flatnonzero(self.condition == 0), np.flatnonzero(self.condition == 1)]
+
+    @classmethod
+    def from_groups(cls, duration_baseline, event_baseline, duration_condition, event_condition):
+        """ Merge the baseline and condition samples, labelling condition subjects with 1 """
+        return cls(np.concatenate([np.asarray(duration_baseline, dtype=float),
+                                   np.asarray(duration_condition, dtype=float)]),
+                   np.concatenate([np.asarray(event_baseline, dtype=float),
+                                   np.asarray(event_condition, dtype=float)]),
+                   np.concatenate([np.zeros(len(duration_baseline)), np.ones(len(duration_condition))]))
+
+
+def _ratio(numerator, denominator):
+    """ Element-wise division that returns 0 where the denominator is not positive """
+    out = np.zeros(np.broadcast(numerator, denominator).shape)
+    return np.divide(numerator, denominator, out=out, where=denominator > 0)
+
+
+def risk_tables(data, weights, condition):
+    """
+    Deaths and numbers at risk at every unique time, per group, for every replicate row.
+
+    weights holds how often each sorted subject is drawn ((replicates, n) or (1, n)) and
+    condition its group label ((n,) or (replicates, n)).
+    """
+    deaths = np.add.reduceat(weights * data.events, data.starts, axis=1)
+    deaths_condition = np.add.reduceat(weights * data.events * condition, data.starts, axis=1)
+    entering = np.add.reduceat(weights * np.ones_like(condition), data.starts, axis=1)
+    entering_condition = np.add.reduceat(weights * condition, data.starts, axis=1)
+    at_risk = np.cumsum(entering[:, ::-1], axis=1)[:, ::-1]
+    at_risk_condition = np.cumsum(entering_condition[:, ::-1], axis=1)[:, ::-1]
+    return (deaths - deaths_condition, at_risk - at_risk_condition,
+            deaths_condition, at_risk_condition)
+
+
+def _km_median(times, deaths, at_risk):
+    """ Kaplan-Meier median survival per replicate row, inf where the curve never drops to 0.5 """
+    survival = np.cumprod(1.0 - _ratio(deaths, at_risk), axis=1)
+    below = survival <= 0.5
+    return np.where(below.any(axis=1), times[below.argmax(axis=1)], np.inf)
+
+
+def cox_log_hazard_ratio(deaths_baseline, at_risk_baseline, deaths_condition, at_risk_condition,
+                         max_iter=50, tol=1e-9):
+    """
+    Newton-Raphson fit of a Cox model on the condition indicator (Breslow ties), all rows at once.
+
+    Returns the log hazard ratio and the observed information at the fit for every row.
+    """
+    deaths = deaths_baseline + deaths_condition
+    observed = deaths_condition.sum(axis=1)
+    beta = np.zeros(len(deaths))
+    for _ in range(max_iter):
+        risk = at_risk_condition * np.exp(beta)[:, None]
+        share = _ratio(risk, at_risk_baseline + risk)
+        score = observed - (deaths * share).sum(axis=1)
+        information = (deaths * share * (1.0 - share)).sum(axis=1)
+        step = np.clip(_ratio(score, information), -_MAX_STEP, _MAX_STEP)
+        beta = np.clip(beta + step, -_MAX_LOG_HR, _MAX_LOG_HR)
+        if np.all(np.abs(step) < tol):
+            break
+    return beta, information
+
+
+def logrank_statistic(deaths_baseline, at_risk_baseline, deaths_condition, at_risk_condition):
+    """ Log-rank chi-squared statistic (1 degree of freedom) per replicate row """
+    deaths = deaths_baseline + deaths_condition
+    at_risk = at_risk_baseline + at_risk_condition
+    share = _ratio(at_risk_condition, at_risk)
+    expected = (deaths * share).sum(axis=1)
+    variance = (deaths * share * (1.0 - share) * _ratio(at_risk - deaths, at_risk - 1.0)).sum(axis=1)
+    return _ratio((deaths_condition.sum(axis=1) - expected) ** 2, variance)
+
+
+def _survival_statistics(data, tables):
+    """ Median survival per group and hazard ratio for each replicate row, as a (replicates, 3) array """
+    deaths_baseline, at_risk_baseline, deaths_condition, at_risk_condition = tables
+    return np.column_stack([
+        _km_median(data.times, deaths_baseline, at_risk_baseline),
+        _km_median(data.times, deaths_condition, at_risk_condition),
+        np.exp(cox_log_hazard_ratio(*tables)[0]),
+    ])
+
+
+def _bootstrap_batch(data, seed, size):
+    """ Draw `size` stratified bootstrap replicates as an index matrix and compute their statistics """
+    rng = np.random.default_rng(seed)
+    index = np.hstack([positions[rng.integers(0, len(positions), (size, len(positions)))]
+                       for positions in data.strata])
+    # how many times each subject is drawn in each replicate
+    offsets = data.n * np.arange(size)[:, None]
+    weights = np.bincount((index + offsets).ravel(), minlength=size * data.n).reshape(size, data.n)
+    return _survival_statistics(data, risk_tables(data, weights.astype(float), data.condition))
+
+
+def _permutation_batch(data, seed, size):
+    """ Draw `size` group-label permutations as an index matrix and compute their log-rank statistics """
+    rng = np.random.default_rng(seed)
+    index = rng.permuted(np.tile(np.arange(data.n), (size, 1)), axis=1)
+    return logrank_statistic(*risk_tables(data, np.ones((1, data.n)), data.condition[index]))
+
+
+def _worker(fn, data, tasks, conn):
+    try:
+        conn.send([fn(data, seed, size) for seed, size in tasks])
+    except Exception:
+        conn.send(RuntimeError(traceback.format_exc()))
+    finally:
+        conn.close()
+
+
+def _run_batches(fn, data, n_replicates, batch_size, seed, workers):
+    """
+    Split n_replicates into batches and run fn over them on a pool of forked processes.
+
+    Processes talk back over pipes rather than multiprocessing queues, because Lambda has no
+    /dev/shm for the semaphores that Pool and ProcessPoolExecutor need. Every batch gets its own
+    child seed, so results do not depend on the number of workers.
+    """
+    sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    tasks = list(zip(np.random.SeedSequence(seed).spawn(len(sizes)), sizes))
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        return np.concatenate([fn(data, task_seed, size) for task_seed, size in tasks])
+
+    ctx = multiprocessing.get_context('fork')
+    pending = {}
+    for i in range(workers):
+        receiver, sender = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_worker, args=(fn, data, tasks[i::workers], sender), daemon=True)
+        process.start()
+        sender.close()
+        pending[receiver] = (i, process)
+
+    results = [None] * workers
+    while pending:
+        for receiver in wait(list(pending)):
+            i, process = pending.pop(receiver)
+            try:
+                results[i] = receiver.recv()
+            except (EOFError, OSError):
+                # the worker died without sending anything, e.g. killed for running out of memory
+                for _, other in pending.values():
+                    other.terminate()
+                for _, other in pending.values():
+                    other.join()
+                process.join()
+                raise RuntimeError('resampling worker for batches %s exited with code %s'
+                                   % (list(range(len(tasks)))[i::workers], process.exitcode))
+            process.join()
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+    # worker i ran batches i, i + workers, ... so interleave them back into batch order
+    batches = [None] * len(tasks)
+    for i, result in enumerate(results):
+        batches[i::workers] = result
+    return np.concatenate(batches)
+
+
+def _percentile_interval(values, alpha):
+    """ Percentile bootstrap interval from the order statistics, so infinite medians are kept """
+    values = np.sort(values)
+    lower = values[int(np.floor(alpha / 2 * len(values)))]
+    upper = values[max(int(np.ceil((1 - alpha / 2) * len(values))) - 1, 0)]
+    return lower, upper
+
+
+def _finite_or_none(value):
+    return float(value) if np.isfinite(value) else None
+
+
+def bootstrap_survival(duration_baseline, event_baseline, duration_condition, event_condition,
+                       n_replicates=1000, alpha=0.05, seed=None, batch_size=256, workers=None):
+    """
+    Bootstrap confidence intervals for median survival of each group and the condition vs baseline hazard ratio.
+
+    Subjects are resampled with replacement within each group. Each batch of replicates is drawn
+    as an index matrix and its Kaplan-Meier medians and Cox hazard ratios are computed for all
+    replicates at once; batches are spread over a process pool.
+
+    Args:
+        duration_baseline (list): Survival durations for the baseline group.
+        event_baseline (list): Survival statuses for the baseline group (0 for Alive, 1 for Dead).
+        duration_condition (list): Survival durations for the condition group.
+        event_condition (list): Survival statuses for the condition group.
+        n_replicates (int): Number of bootstrap replicates.
+        alpha (float): One minus the confidence level of the intervals.
+        seed (int): Seed for reproducible replicates.
+        batch_size (int): Replicates computed together in one vectorized batch.
+        workers (int): Number of processes, defaults to the number of cores.
+
+    Returns:
+        dict: Estimate and lower/upper bounds for the median survival of each group and the
+            hazard ratio. A median of None means the survival curve never drops to 0.5.
+    """
+    data = SurvivalData.from_groups(duration_baseline, event_baseline, duration_condition, event_condition)
+    estimate = _survival_statistics(data, risk_tables(data, np.ones((1, data.n)), data.condition))[0]
+    replicates = _run_batches(_bootstrap_batch, data, n_replicates, batch_size, seed, workers)
+
+    intervals = {}
+    for i, name in enumerate(['baseline', 'condition', 'hazard_ratio']):
+        lower, upper = _percentile_interval(replicates[:, i], alpha)
+        intervals[name] = {
+            'estimate': _finite_or_none(estimate[i]),
+            'lower': _finite_or_none(lower),
+            'upper': _finite_or_none(upper),
+        }
+    return {
+        'n_replicates': n_replicates,
+        'confidence_level': 1 - alpha,
+        'median_survival': {'baseline': intervals['baseline'], 'condition': intervals['condition']},
+        'hazard_ratio': intervals['hazard_ratio'],
+    }
+
+
+def permutation_logrank(duration_baseline, event_baseline, duration_condition, event_condition,
+                        n_permutations=1000, seed=None, batch_size=256, workers=None):
+    """
+    Permutation p-value for the log-rank test of condition vs baseline.
+
+    Group labels are shuffled across subjects, one permutation per index matrix row, and the
+    log-rank statistic of every permutation in a batch is computed at once.
+
+    Returns:
+        dict: The observed log-rank statistic and its permutation p-value.
+    """
+    data = SurvivalData.from_groups(duration_baseline, event_baseline, duration_condition, event_condition)
+    observed = logrank_statistic(*risk_tables(data, np.ones((1, data.n)), data.condition))[0]
+    permuted = _run_batches(_permutation_batch, data, n_permutations, batch_size, seed, workers)
+    exceed = np.count_nonzero(permuted >= observed * (1 - 1e-12))
+    return {
+        'n_permutations': n_permutations,
+        'test_statistic': float(observed),
+        'p_value': float((exceed + 1) / (n_permutations + 1)),
+    }
+
+
+if __name__ == '__main__':
+    # benchmark: python resampling.py --subjects 200 --replicates 1000 5000 10000
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subjects', type=int, default=200,
+                        help='Subjects per group in the synthetic cohort (default: 200)')
+    parser.add_argument('--replicates', type=int, nargs='+', default=[1000, 5000, 10000],
+                        help='Replicate counts to benchmark (default: 1000 5000 10000)')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='Worker counts to benchmark (default: 1, 2, 4, ... up to the number of cores)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    baseline = rng.exponential(1000, args.subjects).round(), rng.random(args.subjects) < 0.7
+    condition = rng.exponential(700, args.subjects).round(), rng.random(args.subjects) < 0.7
+    cores = os.cpu_count() or 1
+    worker_counts = args.workers or sorted({min(2 ** i, cores) for i in range(cores.bit_length() + 1)})
+
+    print('%10s %8s %12s %12s %10s %10s' % ('replicates', 'workers', 'bootstrap_s', 'permute_s', 'speedup', 'efficiency'))
+    for n_replicates in args.replicates:
+        serial = None
+        for workers in worker_counts:
+            start = time.perf_counter()
+            bootstrap_survival(*baseline, *condition, n_replicates=n_replicates, seed=0, workers=workers)
+            bootstrap_time = time.perf_counter() - start
+            start = time.perf_counter()
+            permutation_logrank(*baseline, *condition, n_permutations=n_replicates, seed=0, workers=workers)
+            permute_time = time.perf_counter() - start
+            total = bootstrap_time + permute_time
+            serial = serial or total
+            print('%10d %8d %12.3f %12.3f %10.2f %10.2f' % (n_replicates, workers, bootstrap_time, permute_time,
+                                                           serial / total, serial / total / workers))
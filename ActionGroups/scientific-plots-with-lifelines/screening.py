@@ -0,0 +1,98 @@
+import numpy as np
+from scipy import stats
+
+import resampling
+
+
+# gene expression columns of the clinical_genomic table, as Redshift reports them
+GENE_COLUMNS = ['lrig1', 'hpgd', 'gdf15', 'cdh2', 'postn', 'vcan', 'pdgfra', 'vcam1', 'cd44', 'cd48', 'cd4',
+                'lyl1', 'spi1', 'cd37', 'vim', 'lmo2', 'egr2', 'bgn', 'col4a1', 'col5a1', 'col5a2']
+DURATION_COLUMN = 'survival_duration'
+STATUS_COLUMN = 'survival_status'
+
+_EVENT_CODES = {'1': 1.0, '0': 0.0, 'dead': 1.0, 'alive': 0.0, 'true': 1.0, 'false': 0.0}
+
+
+def _as_events(values):
+    """ Survival status as 0/1 floats, accepting the '1'/'0' and 'Dead'/'Alive' strings stored in Redshift """
+    if values.dtype == object:
+        return np.array([_EVENT_CODES.get(str(value).strip().lower(), np.nan) for value in values])
+    return values.astype(float)
+
+
+def benjamini_hochberg(p_values):
+    """ Benjamini-Hochberg adjusted p-values (false discovery rate q-values) """
+    p_values = np.asarray(p_values, dtype=float)
+    m = len(p_values)
+    order = np.argsort(p_values)
+    scaled = p_values[order] * m / np.arange(1, m + 1)
+    # enforce monotonicity from the largest p-value down
+    adjusted = np.minimum.accumulate(scaled[::-1])[::-1]
+    q_values = np.empty(m)
+    q_values[order] = np.minimum(adjusted, 1.0)
+    return q_values
+
+
+def screen_biomarkers(columns, quantile=0.5, alpha=0.05,
+                      duration_column=DURATION_COLUMN, status_column=STATUS_COLUMN):
+    """
+    Rank every gene expression column by how well a high vs low split separates survival.
+
+    Subjects are sorted by survival duration once and every gene's split is evaluated against
+    that single time index, so all genes are tested in one vectorized pass. For each gene the
+    cohort is split at the given expression quantile; high expression is the condition group.
+    Subjects missing a gene's expression are left out of that gene's test.
+
+    Args:
+        columns (dict): Column name to array, e.g. from spill_reader.read_columns.
+        quantile (float): Expression quantile used as the split threshold for each gene.
+        alpha (float): One minus the confidence level of the hazard ratio intervals.
+        duration_column (str): Name of the survival duration column.
+        status_column (str): Name of the survival status column (1 or Dead for an event).
+
+    Returns:
+        list: One dict per gene with the split threshold, group sizes, log-rank statistic,
+            p-value, Benjamini-Hochberg q-value, Bonferroni p-value and the Cox hazard ratio
+            of high vs low expression with its confidence interval, ordered by p-value.
+    """
+    names = {name.lower(): name for name in columns}
+    durations = np.asarray(columns[names[duration_column]], dtype=float)
+    events = _as_events(np.asarray(columns[names[status_column]]))
+    genes = [names[gene] for gene in GENE_COLUMNS if gene in names]
+    if not genes:
+        # not the clinical_genomic layout, screen every other numeric column instead
+        genes = [name for name, column in columns.items()
+                 if name.lower() not in (duration_column, status_column) and column.dtype.kind in 'iuf']
+
+    valid = np.isfinite(durations) & np.isfinite(events)
+    data = resampling.SurvivalData(durations[valid], events[valid], np.zeros(np.count_nonzero(valid)))
+    expression = np.vstack([np.asarray(columns[gene], dtype=float)[valid][data.order] for gene in genes])
+    thresholds = np.nanquantile(expression, quantile, axis=1)
+    high = (expression > thresholds[:, None]).astype(float)
+    # subjects without a value for a gene are left out of that gene's test, not counted as low
+    measured = np.isfinite(expression).astype(float)
+
+    tables = resampling.risk_tables(data, measured, high)
+    chi_squared = resampling.logrank_statistic(*tables)
+    p_values = stats.chi2.sf(chi_squared, 1)
+    log_hr, information = resampling.cox_log_hazard_ratio(*tables)
+    with np.errstate(divide='ignore'):
+        margin = stats.norm.ppf(1 - alpha / 2) / np.sqrt(information)
+    q_values = benjamini_hochberg(p_values)
+
+    results = []
+    for i in np.argsort(p_values, kind='stable'):
+        results.append({
+            'biomarker': genes[i],
+            'threshold': float(thresholds[i]),
+            'n_low': int(measured[i].sum() - high[i].sum()),
+            'n_high': int(high[i].sum()),
+            'logrank_statistic': float(chi_squared[i]),
+            'p_value': float(p_values[i]),
+            'q_value': float(q_values[i]),
+            'bonferroni_p_value': float(min(p_values[i] * len(genes), 1.0)),
+            'hazard_ratio': float(np.exp(log_hr[i])),
+            'hazard_ratio_lower': float(np.exp(log_hr[i] - margin[i])),
+            'hazard_ratio_upper': float(np.exp(log_hr[i] + margin[i])),
+        })
+    return results
@@ -0,0 +1,188 @@
+import array
+import codecs
+import json
+
+import numpy as np
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+# Redshift Data API field keys that map onto compact array typecodes
+_TYPECODES = {'booleanValue': 'b', 'longValue': 'q', 'doubleValue': 'd'}
+_DTYPES = {'b': np.int8, 'q': np.int64, 'd': np.float64}
+
+
+class _StreamBuffer:
+    """ Text window over a binary stream that is decoded one chunk at a time """
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Drop consumed text and append the next chunk, return False at end of stream """
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if chunk:
+            decoded = self.decoder.decode(chunk)
+        else:
+            self.eof = True
+            decoded = self.decoder.decode(b'', final=True)
+        self.text = self.text[self.pos:] + decoded
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Return the next non-whitespace character without consuming it, '' at end of stream """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Malformed spill object: expected '{char}' but found '{found}'")
+        self.pos += 1
+
+    def value(self):
+        """ Decode the next complete JSON value, reading more of the stream as needed """
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # a number ending exactly at the buffer edge may continue in the next chunk
+            if end == len(self.text) and self.fill():
+                continue
+            self.pos = end
+            return obj
+
+
+class _Column:
+    """ Accumulates one result column into a compact array keyed on the first non-null cell type """
+
+    __slots__ = ('typecode', 'values', 'nulls', 'length')
+
+    def __init__(self):
+        self.typecode = None
+        self.values = None
+        self.nulls = []
+        self.length = 0
+
+    def _start(self, typecode):
+        self.typecode = typecode
+        if typecode is None:
+            self.values = [None] * self.length
+        else:
+            self.values = array.array(typecode, bytes(array.array(typecode).itemsize * self.length))
+
+    def append(self, cell):
+        (field, value), = cell.items()
+        if field == 'isNull':
+            self.nulls.append(self.length)
+            if self.values is not None:
+                self.values.append(None if self.typecode is None else 0)
+        else:
+            typecode = _TYPECODES.get(field)
+            if self.values is None:
+                self._start(typecode)
+            elif typecode != self.typecode:
+                self._widen(typecode)
+            self.values.append(value)
+        self.length += 1
+
+    def _widen(self, typecode):
+        """ Promote longs to doubles, anything else mixed to a plain object list """
+        if {typecode, self.typecode} == {'q', 'd'}:
+            self.values = array.array('d', self.values)
+            self.typecode = 'd'
+        elif self.typecode is not None:
+            self.values = list(self.values)
+            self.typecode = None
+
+    def to_numpy(self):
+        if self.values is None:
+            return np.full(self.length, np.nan)
+        if self.typecode is None:
+            column = np.array(self.values, dtype=object)
+            column[self.nulls] = None
+            return column
+        column = np.frombuffer(self.values, dtype=_DTYPES[self.typecode])
+        if self.typecode == 'b':
+            column = column.astype(bool)
+        if self.nulls:
+            column = column.astype(np.float64)
+            column[self.nulls] = np.nan
+        return column
+
+
+def _read(body, chunk_size):
+    """ Walk the top-level object, streaming Records row by row and decoding the other keys whole """
+    stream = _StreamBuffer(body, chunk_size)
+    metadata = []
+    columns = None
+    stream.expect('{')
+    while stream.peek() != '}':
+        key = stream.value()
+        stream.expect(':')
+        if key == 'Records':
+            stream.expect('[')
+            while stream.peek() != ']':
+                row = stream.value()
+                if columns is None:
+                    columns = [_Column() for _ in row]
+                for column, cell in zip(columns, row):
+                    column.append(cell)
+                if stream.peek() == ',':
+                    stream.pos += 1
+            stream.expect(']')
+        elif key == 'ColumnMetadata':
+            metadata = stream.value()
+        else:
+            stream.value()
+        if stream.peek() == ',':
+            stream.pos += 1
+    stream.expect('}')
+    return metadata, [column.to_numpy() for column in columns or []]
+
+
+def read_records(body, chunk_size=1 << 20):
+    """
+    Stream a Redshift Data API result spilled to S3 and return its Records as typed column arrays.
+
+    The body is read chunk by chunk and each row is decoded on its own, so only the current
+    chunk and the compact per-column arrays are held in memory, never the full JSON tree.
+
+    Args:
+        body: File-like object with a read(size) method, e.g. the S3 get_object StreamingBody.
+        chunk_size (int): Number of bytes to read from the body at a time.
+
+    Returns:
+        list: One numpy array per result column, in column order. Boolean, long and double
+            columns come back as bool, int64 and float64 arrays (float64 with NaN if they
+            contain nulls), string columns as object arrays.
+    """
+    return _read(body, chunk_size)[1]
+
+
+def read_columns(body, chunk_size=1 << 20):
+    """ Like read_records, but keyed by the column names in ColumnMetadata """
+    metadata, columns = _read(body, chunk_size)
+    if not columns:
+        columns = [np.array([]) for _ in metadata]
+    if len(metadata) != len(columns):
+        raise ValueError('Spill object has no ColumnMetadata matching its Records')
+    return {column_meta['name']: column for column_meta, column in zip(metadata, columns)}
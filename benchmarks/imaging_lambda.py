@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the imaging action group Lambda against a local fake S3 and Step Functions server.
+
+    python benchmarks/imaging_lambda.py analyze --subjects 10 100 --latency 0.03
+
+The server answers GetObject for the CSV and Parquet features and the STATUS
+of a subject in a batch, shaped like the processing job's (one subject in ten was processed
+before the Parquet partitions and only has its CSV file), and DescribeExecution and
+GetExecutionHistory for one running and one finished execution, after
+--latency seconds.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+import types
+from email.utils import formatdate
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import boto3
+import numpy as np
+import pandas as pd
+from botocore.config import Config
+
+os.environ.setdefault('SFN_STATEMACHINE_NAME', 'imaging-benchmark')
+os.environ.setdefault('S3BUCKET', 's3://imaging-benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ActionGroups', 'imaging-biomarker'))
+import dummy_lambda  # noqa: E402
+import feature_table  # noqa: E402
+
+BUCKET = 'imaging-benchmark'
+CONTEXT = types.SimpleNamespace(invoked_function_arn='arn:aws:lambda:us-east-1:123456789012:function:imaging-benchmark')
+
+
+def subject_id(i):
+    return 'R01-%03d' % i
+
+
+def feature_row(subject, n_features=107, seed=0):
+    """ compute_features output of one subject: diagnostics, features of the image types and file names """
+    rng = np.random.default_rng(seed)
+    image_types = ['original'] + ['wavelet-%s' % w for w in ('LLH', 'LHL', 'LHH', 'HLL', 'HLH', 'HHL', 'HHH', 'LLL')]
+    classes = ['firstorder', 'glcm', 'glrlm', 'glszm', 'gldm', 'ngtdm']
+    row = {'diagnostics_Versions_PyRadiomics': 'v3.0.1', 'diagnostics_Mask-original_VoxelNum': 4096}
+    row.update(('original_shape_Feature%02d' % i, rng.normal()) for i in range(14))
+    row.update(('%s_%s_Feature%03d' % (image_types[(i // 93) % len(image_types)], classes[i % len(classes)], i),
+                rng.normal()) for i in range(n_features - 14))
+    row.update({'imageName': '/opt/ml/processing/output/CT-Nifti/%s.nii.gz' % subject,
+                'maskName': '/opt/ml/processing/output/CT-SEG/%s.nii.gz' % subject})
+    return pd.DataFrame([row])
+
+
+def batch_name(execution):
+    return 'dcm-nifti-conversion-%s' % execution
+
+
+def feature_objects(subject, n_features=107, seed=0, batch=batch_name('finished')):
+    """ The CSV, Parquet and STATUS objects the processing job of batch writes for one subject, by key """
+    df = feature_row(subject, n_features, seed)
+    parquet = io.BytesIO()
+    feature_table.feature_frame(df, subject, '09-09-1991', 1700000000.0).to_parquet(parquet, index=False)
+    df['Subject'] = subject
+    df['EventTime'] = 1700000000.0
+    df['ScanDate'] = '09-09-1991'
+    return {
+        'nsclc_radiogenomics/CSV/%s.csv' % subject: df.to_csv().encode('utf-8'),
+        'nsclc_radiogenomics/PARQUET/%s' % feature_table.partition_key(subject): parquet.getvalue(),
+        'nsclc_radiogenomics/STATUS/%s/%s.json' % (batch, subject): json.dumps(
+            {'subject': subject, 'status': 'Succeeded', 'exit_code': 0, 'seconds': 60.0}).encode('utf-8'),
+    }
+
+
+def fake_execution(name, subjects, state):
+    """ DescribeExecution and the latest GetExecutionHistory events of an execution in state """
+    started = time.time() - 3600
+    arn = 'arn:aws:states:us-east-1:123456789012:execution:imaging-benchmark:%s' % name
+    execution = {'executionArn': arn, 'name': name, 'startDate': started,
+                 'stateMachineArn': 'arn:aws:states:us-east-1:123456789012:stateMachine:imaging-benchmark',
+                 'status': 'RUNNING' if state != 'Finish' else 'SUCCEEDED',
+                 'input': json.dumps({'PreprocessingJobName': batch_name(name), 'Subject': subjects})}
+    if state == 'Finish':
+        execution['stopDate'] = started + 1800
+    events = [{'id': 4, 'timestamp': started + 1700, 'type': 'TaskStateEntered',
+               'stateEnteredEventDetails': {'name': state}}]
+    return arn, {'DescribeExecution': execution, 'GetExecutionHistory': {'events': events}}
+
+
+class FakeS3(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        key = urllib.parse.unquote(self.path.split('?')[0].split('/', 2)[-1])
+        data = self.server.objects.get(key)
+        if data is None:
+            data = b'<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message></Error>'
+            self.send_response(404)
+            self.send_header('Content-Type', 'application/xml')
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Last-Modified', formatdate(usegmt=True))
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        """ Step Functions, JSON protocol """
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.latency)
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        operation = self.headers['X-Amz-Target'].split('.')[-1]
+        data = json.dumps(self.server.executions[request['executionArn']][operation]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(latency, n_subjects, n_features=107):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeS3)
+    server.latency = latency
+    server.requests = 0
+    server.lock = threading.Lock()
+    server.objects = {}
+    for i in range(n_subjects):
+        objects = feature_objects(subject_id(i), n_features, seed=i)
+        if i % 10 == 9:
+            del objects['nsclc_radiogenomics/PARQUET/%s' % feature_table.partition_key(subject_id(i))]
+        server.objects.update(objects)
+        if i % 2 == 0:
+            # half of the subjects of the running execution are done
+            server.objects['nsclc_radiogenomics/STATUS/%s/%s.json' % (batch_name('running'), subject_id(i))] = \
+                objects['nsclc_radiogenomics/STATUS/%s/%s.json' % (batch_name('finished'), subject_id(i))]
+    subjects = [subject_id(i) for i in range(n_subjects)]
+    server.executions = dict([fake_execution('finished', subjects, 'Finish'),
+                              fake_execution('running', subjects, dummy_lambda.PROCESSING_STATE)])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = 'http://127.0.0.1:%d' % server.server_address[1]
+    dummy_lambda.s3_client = boto3.client(
+        's3', endpoint_url=endpoint,
+        config=Config(max_pool_connections=dummy_lambda.MAX_WORKERS, s3={'addressing_style': 'path'}))
+    dummy_lambda.sfn_client = boto3.client('stepfunctions', endpoint_url=endpoint)
+    return server
+
+
+def analyze_event(subjects, features=None, aggregate=None):
+    parameters = [{'name': 'subject_id', 'value': json.dumps(subjects)}]
+    if features:
+        parameters.append({'name': 'features', 'value': json.dumps(features)})
+    if aggregate:
+        parameters.append({'name': 'aggregate', 'value': json.dumps(aggregate)})
+    return {'actionGroup': 'imaging', 'function': 'analyze_imaging_biomarker', 'parameters': parameters}
+
+
+def status_event(execution_arns, aggregate=None):
+    parameters = [{'name': 'execution_arn', 'value': json.dumps(execution_arns)}]
+    if aggregate:
+        parameters.append({'name': 'aggregate', 'value': json.dumps(aggregate)})
+    return {'actionGroup': 'imaging', 'function': 'get_imaging_biomarker_status', 'parameters': parameters}
+
+
+def analyze(subjects, features=None, aggregate=None):
+    """ Seconds taken by analyze_imaging_biomarker and its response body """
+    start = time.perf_counter()
+    response = dummy_lambda.lambda_handler(analyze_event(subjects, features, aggregate), CONTEXT)
+    elapsed = time.perf_counter() - start
+    return elapsed, response['response']['functionResponse']['responseBody']['TEXT']['body']
+
+
+def sequential_body(subjects):
+    """ The previous analyze_imaging_biomarker: one subject after the other, lists concatenated """
+    result = []
+    for id in subjects:
+        try:
+            response = dummy_lambda.s3_client.get_object(Bucket=BUCKET, Key=f'nsclc_radiogenomics/CSV/{id}.csv')
+            df = pd.read_csv(io.StringIO(response['Body'].read().decode('utf-8')))
+            df['subject_id'] = id
+            result = result + json.loads(df.to_json(orient='records'))
+        except Exception as e:
+            print(f'Error: {e}')
+    return str(result)
+
+
+def bench_analyze(server, args):
+    """ Sequential reads (the previous behaviour) vs the thread pool and single serialization """
+    print('%9s %14s %12s %8s %10s %8s' % ('subjects', 'sequential_s', 'parallel_s', 'speedup', 'body_kB', 'errors'))
+    for n in args.subjects:
+        # one subject in ten was never processed
+        subjects = [subject_id(i) for i in range(n)] + [subject_id(10000 + i) for i in range(n // 10)]
+        start = time.perf_counter()
+        sequential_body(subjects)
+        sequential = time.perf_counter() - start
+        parallel, body = analyze(subjects)
+        body = json.loads(body)
+        assert len(body['features']) == n
+        print('%9d %14.2f %12.2f %8.1f %10.0f %8d' % (len(subjects), sequential, parallel, sequential / parallel,
+                                                      len(json.dumps(body)) / 1024, len(body['errors'])))
+
+
+def bench_projection(server, args):
+    """ Response size and latency of every feature per subject vs feature subsets and aggregates """
+    subjects = [subject_id(i) for i in range(max(args.subjects))]
+    cases = [
+        ('all features', None, None),
+        ('original_shape_*', ['original_shape_*'], None),
+        ('wavelet-LLH_*', ['wavelet-LLH_*'], None),
+        ('all: mean,std,quantiles', None, ['mean', 'std', 'quantiles']),
+        ('original_shape_*: mean,std', ['original_shape_*'], ['mean', 'std']),
+    ]
+    print('%d subjects, %d features each' % (len(subjects), args.features))
+    print('%-28s %10s %12s %8s %8s' % ('request', 'seconds', 'body_kB', 'columns', 'of'))
+    for name, features, aggregate in cases:
+        elapsed, body = analyze(subjects, features, aggregate)
+        result = json.loads(body)
+        columns = len(result['aggregates']) if aggregate else len(
+            set(result['features'][0]) - {'subject_id', 'scan_date', 'event_time'})
+        total = result['truncated']['features_total'] if 'truncated' in result else columns
+        print('%-28s %10.2f %12.1f %8d %8d' % (name, elapsed, len(body) / 1024, columns, total))
+
+
+def bench_status(server, args):
+    """ Polls of a running and a finished execution: the first poll of a finished one vs the cached ones """
+    finished, running = list(server.executions)
+    cases = [
+        ('running', [running], None),
+        ('finished, first poll', [finished], None),
+        ('finished, cached', [finished], None),
+        ('finished, first + mean', [finished], ['mean']),
+        ('finished, cached + mean', [finished], ['mean']),
+        ('both, cached', [running, finished], None),
+    ]
+    print('%d subjects per execution' % max(args.subjects))
+    print('%-26s %10s %10s %10s' % ('poll', 'seconds', 'requests', 'body_kB'))
+    for name, execution_arns, aggregate in cases:
+        requests = server.requests
+        start = time.perf_counter()
+        response = dummy_lambda.lambda_handler(status_event(execution_arns, aggregate), CONTEXT)
+        elapsed = time.perf_counter() - start
+        body = response['response']['functionResponse']['responseBody']['TEXT']['body']
+        executions = json.loads(body)['executions']
+        assert len(executions) == len(execution_arns)
+        print('%-26s %10.3f %10d %10.1f' % (name, elapsed, server.requests - requests, len(body) / 1024))
+
+
+BENCHMARKS = {
+    'analyze': bench_analyze,
+    'status': bench_status,
+    'projection': bench_projection,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.03,
+                        help='Simulated time to first byte of the fake S3 server in seconds (default: 0.03)')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[10, 100],
+                        help='Subjects per request (default: 10 100)')
+    parser.add_argument('--features', type=int, default=107,
+                        help='Features per subject, 107 for the PyRadiomics defaults, 851 with wavelets (default: 107)')
+    args = parser.parse_args()
+
+    server = serve(args.latency, max(args.subjects), args.features)
+    try:
+        BENCHMARKS[args.benchmark](server, args)
+    finally:
+        server.shutdown()
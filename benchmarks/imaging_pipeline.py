@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the imaging processing job on local NSCLC Radiogenomics subjects.
+
+    python benchmarks/imaging_pipeline.py subjects --data_dir ./nsclc_radiogenomics --workers 4
+
+data_dir holds one directory per subject, laid out as in the
+sagemaker-solutions-prod dataset (<subject>/<study>/<date>/<series>/...).
+Without it, --synthetic N writes N subjects with a CT series and a DICOM
+SEG of a textured spherical tumor to a temporary directory.
+Needs the imaging container's requirements (pydicom, dcmstack, nibabel,
+nilearn, pyradiomics), e.g. run it inside the processing image.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from glob import glob
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ActionGroups', 'imaging-biomarker'))
+import dcm2nifti_processing  # noqa: E402
+import nibabel as nib  # noqa: E402
+import numpy as np  # noqa: E402
+import pydicom  # noqa: E402
+import radiomics_utils  # noqa: E402
+from pydicom.dataset import Dataset, FileMetaDataset  # noqa: E402
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid  # noqa: E402
+
+
+OUTPUTS = ('CT-Nifti', 'CT-SEG', 'PNG', 'CSV')
+
+
+def output_dir(tmp, name):
+    path = os.path.join(tmp, name)
+    for output in OUTPUTS:
+        os.makedirs(os.path.join(path, output), exist_ok=True)
+    return path
+
+
+def list_subjects(args):
+    if not args.data_dir:
+        sys.exit('--data_dir is required for this benchmark')
+    subjects = args.subjects or sorted(i for i in os.listdir(args.data_dir)
+                                       if os.path.isdir(os.path.join(args.data_dir, i)))
+    return subjects[:args.max_subjects] if args.max_subjects else subjects
+
+
+def _dicom(path, sop_class, **elements):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = sop_class
+    meta.MediaStorageSOPInstanceUID = elements['SOPInstanceUID']
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dcm = Dataset()
+    dcm.file_meta = meta
+    dcm.SOPClassUID = sop_class
+    dcm.is_little_endian, dcm.is_implicit_VR = True, False
+    for name, value in elements.items():
+        setattr(dcm, name, value)
+    dcm.save_as(path, write_like_original=False)
+
+
+def write_synthetic_subject(data_dir, subject, n_slices=120, rows=512, spacing=(0.7, 0.7, 2.5), radius=25.0,
+                            seed=0):
+    """
+    Write a CT series and a binary DICOM SEG of one subject, laid out like the NSCLC Radiogenomics data:
+    <subject>/<study>/<date>/<series>/*.dcm with a <series>.json description next to each series.
+    """
+    rng = np.random.RandomState(seed)
+    study, frame_of_reference = generate_uid(), generate_uid()
+    ct_series, seg_series = generate_uid(), generate_uid()
+    date = '01-01-2000-NA-CT CHEST-%05d' % seed
+    study_dir = os.path.join(data_dir, subject, study, date)
+    common = dict(PatientID=subject, StudyInstanceUID=study, FrameOfReferenceUID=frame_of_reference,
+                  StudyDate='20000101', Rows=rows, Columns=rows, SamplesPerPixel=1,
+                  PhotometricInterpretation='MONOCHROME2', ImageOrientationPatient=[1, 0, 0, 0, 1, 0],
+                  PixelSpacing=list(spacing[:2]))
+    origin = (-rows * spacing[0] / 2, -rows * spacing[1] / 2, -n_slices * spacing[2] / 2)
+    center = np.array([rows * 0.3, rows * 0.45, n_slices * 0.5])
+
+    # body at 0 HU in air, tumor at 40 HU, with noise; stored values are HU + 1024
+    y, x = np.mgrid[:rows, :rows]
+    body = ((x - rows / 2) / (rows * 0.42)) ** 2 + ((y - rows / 2) / (rows * 0.32)) ** 2 <= 1
+    os.makedirs(os.path.join(study_dir, 'ct'))
+    tumor_slices = {}
+    for k in range(n_slices):
+        distance = (((x - center[0]) * spacing[0]) ** 2 + ((y - center[1]) * spacing[1]) ** 2
+                    + ((k - center[2]) * spacing[2]) ** 2)
+        tumor = distance <= radius ** 2
+        hu = np.where(body, 0, -1000) + np.where(tumor, 40, 0) + rng.normal(0, 20, (rows, rows))
+        if tumor.any():
+            tumor_slices[k] = tumor
+        instance = n_slices - k
+        _dicom(os.path.join(study_dir, 'ct', '1-%03d.dcm' % instance), '1.2.840.10008.5.1.4.1.1.2',
+               SOPInstanceUID=generate_uid(), Modality='CT', SeriesInstanceUID=ct_series, SeriesNumber=1,
+               InstanceNumber=instance, ImagePositionPatient=[origin[0], origin[1], origin[2] + k * spacing[2]],
+               SliceThickness=spacing[2], BitsAllocated=16, BitsStored=12, HighBit=11, PixelRepresentation=0,
+               RescaleIntercept=-1024, RescaleSlope=1, PixelData=np.clip(hu + 1024, 0, 4095).astype(np.uint16).tobytes(),
+               **common)
+
+    # one binary frame per tumor slice, transmitted top down like the ePAD objects
+    frames = sorted(tumor_slices, reverse=True)
+    mask = np.stack([tumor_slices[k] for k in frames]).astype(np.uint8)
+    functional_groups = []
+    for k in frames:
+        position = Dataset()
+        position.ImagePositionPatient = [origin[0], origin[1], origin[2] + k * spacing[2]]
+        group = Dataset()
+        group.PlanePositionSequence = [position]
+        functional_groups.append(group)
+    os.makedirs(os.path.join(study_dir, 'seg'))
+    _dicom(os.path.join(study_dir, 'seg', '1-1.dcm'), '1.2.840.10008.5.1.4.1.1.66.4',
+           SOPInstanceUID=generate_uid(), Modality='SEG', SeriesInstanceUID=seg_series, SeriesNumber=1000,
+           InstanceNumber=1, NumberOfFrames=len(frames), SegmentationType='BINARY', BitsAllocated=1,
+           BitsStored=1, HighBit=0, PixelRepresentation=0, PerFrameFunctionalGroupsSequence=functional_groups,
+           PixelData=np.packbits(mask.ravel(), bitorder='little').tobytes(), **common)
+
+    for series, description in ((ct_series, 'CT CHEST'), (seg_series, 'ePAD Generated DSO')):
+        with open(os.path.join(study_dir, '%s.json' % series), 'w') as f:
+            json.dump({'StudyUID': study, 'Date': date, 'SeriesUID': series, 'Total': [subject, description]}, f)
+    return n_slices, len(frames)
+
+
+def bench_subjects(args):
+    """ One processing job per subject (the previous Map state) vs one job processing every subject in parallel """
+    subjects = list_subjects(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        # per subject jobs: every subject pays the job start up (instance provisioning, image pull) on its own
+        start = time.time()
+        statuses = dcm2nifti_processing.process_subjects(subjects, args.data_dir, output_dir(tmp, 'serial'), 1)
+        serial = time.time() - start
+        mean_subject = sum(status['seconds'] for status in statuses) / len(statuses)
+
+        start = time.time()
+        statuses = dcm2nifti_processing.process_subjects(subjects, args.data_dir, output_dir(tmp, 'parallel'),
+                                                         args.workers)
+        parallel = time.time() - start
+    failed = [status['subject'] for status in statuses if status['status'] != 'Succeeded']
+
+    per_job_hours = len(subjects) * (args.job_overhead + mean_subject) / 3600
+    batch_hours = (args.job_overhead + parallel) / 3600
+    print('%d subjects, mean %.1f s each, %.1f s in one process, %.1f s with %d workers, job start up %.0f s'
+          % (len(subjects), mean_subject, serial, parallel, args.workers, args.job_overhead))
+    print('%-22s %14s %22s' % ('mode', 'instance_hours', 'subjects/instance_hour'))
+    print('%-22s %14.3f %22.1f' % ('job per subject', per_job_hours, len(subjects) / per_job_hours))
+    print('%-22s %14.3f %22.1f' % ('one multi-subject job', batch_hours, len(subjects) / batch_hours))
+    if failed:
+        print('failed subjects: %s' % ', '.join(failed))
+
+
+def _process_subject(subject, data_dir, output):
+    start = time.time()
+    dcm2nifti_processing.process_subject(subject, os.path.join(data_dir, subject), output)
+    return time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_footprint(args):
+    """ Peak memory, time and NIfTI output sizes of processing each subject, every subject in a fresh process """
+    print('%-10s %10s %14s %12s %12s' % ('subject', 'seconds', 'peak_rss_MB', 'ct_nii_MB', 'seg_nii_KB'))
+    with tempfile.TemporaryDirectory() as tmp:
+        output = output_dir(tmp, 'output')
+        for subject in list_subjects(args):
+            with multiprocessing.Pool(1) as pool:
+                seconds, peak = pool.apply(_process_subject, (subject, args.data_dir, output))
+            ct = os.path.getsize(os.path.join(output, 'CT-Nifti', '%s.nii.gz' % subject))
+            seg = os.path.getsize(os.path.join(output, 'CT-SEG', '%s.nii.gz' % subject))
+            print('%-10s %10.1f %14.0f %12.1f %12.1f' % (subject, seconds, peak, ct / 2 ** 20, seg / 2 ** 10))
+
+
+def load_in_memory(image_name, mask_name):
+    """ Read a written CT and mask back as in-memory images, as the processing job holds them """
+    return [nib.Nifti1Image(np.asanyarray(i.dataobj), i.affine, i.header)
+            for i in (nib.load(image_name), nib.load(mask_name))]
+
+
+def processed_subjects(args, output):
+    """ Process every subject into output and yield its CT and mask .nii.gz paths """
+    for subject in list_subjects(args):
+        dcm2nifti_processing.process_subject(subject, os.path.join(args.data_dir, subject), output)
+        yield (os.path.join(output, 'CT-Nifti', '%s.nii.gz' % subject),
+               os.path.join(output, 'CT-SEG', '%s.nii.gz' % subject))
+
+
+def bench_batch(args):
+    """ compute_features_batch over the processed subjects with 1 to --workers processes, with scaling efficiency """
+    radiomics_utils.configure_extractor(args.radiomics_params)
+    with tempfile.TemporaryDirectory() as tmp:
+        pairs = list(processed_subjects(args, output_dir(tmp, 'output')))
+        counts = sorted({2 ** i for i in range(int(np.log2(args.workers)) + 1)} | {args.workers})
+        print('%8s %10s %10s %12s %16s' % ('workers', 'seconds', 'speedup', 'efficiency', 'subjects/hour'))
+        for workers in counts:
+            start = time.time()
+            df = radiomics_utils.compute_features_batch(pairs, workers, args.split_image_types)
+            seconds = time.time() - start
+            assert len(df) == len(pairs)
+            if workers == 1:
+                baseline = seconds
+            print('%8d %10.2f %10.2f %12.2f %16.0f' % (workers, seconds, baseline / seconds,
+                                                       baseline / seconds / workers, len(pairs) * 3600 / seconds))
+
+
+def bench_classes(args):
+    """ Extraction time over the subjects with every default feature class vs only --feature_classes """
+    with tempfile.TemporaryDirectory() as tmp:
+        pairs = [(names, radiomics_utils.crop_to_mask(*load_in_memory(*names)))
+                 for names in processed_subjects(args, output_dir(tmp, 'output'))]
+    print('%-28s %10s %10s %14s' % ('feature_classes', 'features', 'seconds', 's/subject'))
+    for feature_classes in (None, args.feature_classes):
+        radiomics_utils.configure_extractor(feature_classes=feature_classes)
+        start = time.time()
+        for (image_name, mask_name), (image, mask) in pairs:
+            df = radiomics_utils.compute_features(image_name, mask_name, image, mask)
+        seconds = time.time() - start
+        features = [i for i in df.columns if i.startswith('original_')]
+        print('%-28s %10d %10.2f %14.3f' % (','.join(feature_classes or ['default']), len(features), seconds,
+                                             seconds / len(pairs)))
+
+
+def bench_radiomics(args):
+    """ PyRadiomics on the full .nii.gz volumes vs on the mask bounding box cropped in memory """
+    print('%-10s %12s %10s %14s %18s' % ('subject', 'full_s', 'crop_s', 'cropped_s', 'max_feature_diff'))
+    with tempfile.TemporaryDirectory() as tmp:
+        output = output_dir(tmp, 'output')
+        for subject in list_subjects(args):
+            dcm2nifti_processing.process_subject(subject, os.path.join(args.data_dir, subject), output)
+            image_name = os.path.join(output, 'CT-Nifti', '%s.nii.gz' % subject)
+            mask_name = os.path.join(output, 'CT-SEG', '%s.nii.gz' % subject)
+            start = time.time()
+            full = radiomics_utils.compute_features(image_name, mask_name)
+            full_seconds = time.time() - start
+
+            # decompress outside the timing, the processing job has the volumes in memory already
+            image, mask = load_in_memory(image_name, mask_name)
+            start = time.time()
+            image, mask = radiomics_utils.crop_to_mask(image, mask)
+            crop_seconds = time.time() - start
+            cropped = radiomics_utils.compute_features(image_name, mask_name, image, mask)
+            cropped_seconds = time.time() - start - crop_seconds
+
+            features = [i for i in full.columns if i.startswith('original_')]
+            difference = (full[features].astype(float) - cropped[features].astype(float)).abs().values.max()
+            print('%-10s %12.2f %10.2f %14.2f %18g' % (subject, full_seconds, crop_seconds, cropped_seconds,
+                                                       difference))
+
+
+def bench_index(args):
+    """ Header-only index of a subject's DICOM files vs reading every file in full, as the mismatch branch did """
+    print('%-10s %8s %12s %12s %8s' % ('subject', 'files', 'index_s', 'full_read_s', 'series'))
+    for subject in list_subjects(args):
+        paths = glob(os.path.join(args.data_dir, subject, '*', '*', '*', '*dcm'))
+        start = time.time()
+        index = dcm2nifti_processing.index_dicoms(paths)
+        indexed = time.time() - start
+        start = time.time()
+        for path in paths:
+            pydicom.dcmread(path)
+        full = time.time() - start
+        print('%-10s %8d %12.2f %12.2f %8d' % (subject, len(paths), indexed, full, len(index)))
+
+
+def synthetic_seg(n_slices, frame_slices, rows=512, z0=-300.0, spacing=2.5):
+    """ CT slice positions, a NIfTI affine and a SEG-like dataset with one binary frame per entry of frame_slices """
+    ct_positions = [(-180.0, -200.0, z0 + k * spacing) for k in reversed(range(n_slices))]
+    affine = np.diag([-0.7, 0.7, spacing, 1.0])
+    affine[:3, 3] = [180.0, 400.0, z0]
+    frame = types.SimpleNamespace
+    dcm = frame(PerFrameFunctionalGroupsSequence=[
+        frame(PlanePositionSequence=[frame(ImagePositionPatient=['-180', '-200', str(z0 + k * spacing)])])
+        for k in frame_slices])
+    frames = np.zeros((len(frame_slices), rows, rows), dtype=np.uint8)
+    frames[:, rows // 3:rows // 2, rows // 3:rows // 2] = 1
+    return ct_positions, affine, dcm, frames
+
+
+def bench_mask(args):
+    """ Previous float64 padding of contiguous frames vs the uint8 mask with per-frame position lookup """
+    n_slices = 300
+    print('%-10s %8s %12s %12s' % ('method', 'frames', 'peak_MB', 'ms'))
+    for n_frames in (40, 120):
+        frame_slices = list(range(100, 100 + n_frames))
+        ct_positions, affine, dcm, frames = synthetic_seg(n_slices, frame_slices)
+        seg = np.fliplr(frames.T)
+        shape = seg.shape[:2] + (n_slices,)
+        img = np.empty(shape)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        previous = np.zeros_like(img)
+        previous[:, :, frame_slices[0]:frame_slices[0] + n_frames] = seg
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-10s %8d %12.1f %12.1f' % ('float64', n_frames, peak / 2 ** 20, elapsed * 1000))
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        slices = dcm2nifti_processing.seg_frame_slices(dcm, ct_positions, affine, n_slices)
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[:, :, slices] = seg > 0
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-10s %8d %12.1f %12.1f' % ('uint8', n_frames, peak / 2 ** 20, elapsed * 1000))
+        assert np.array_equal(previous.astype(np.uint8), mask)
+
+
+BENCHMARKS = {
+    'footprint': bench_footprint,
+    'batch': bench_batch,
+    'classes': bench_classes,
+    'mask': bench_mask,
+    'radiomics': bench_radiomics,
+    'index': bench_index,
+    'subjects': bench_subjects,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--data_dir',
+                        help='Directory with one subdirectory of DICOM data per subject (not needed for mask)')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Write this many synthetic subjects to a temporary data_dir (default: 0)')
+    parser.add_argument('--slices', type=int, default=120,
+                        help='CT slices per synthetic subject (default: 120)')
+    parser.add_argument('--subjects', nargs='+',
+                        help='Subjects to process (default: every subdirectory of data_dir)')
+    parser.add_argument('--max_subjects', type=int, default=0,
+                        help='Process at most this many subjects (default: all)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Subjects processed in parallel (default: CPU count)')
+    parser.add_argument('--feature_classes', nargs='+', default=['firstorder', 'shape'],
+                        help='Feature classes of the classes benchmark (default: firstorder shape)')
+    parser.add_argument('--radiomics_params',
+                        help='PyRadiomics parameter file of the batch benchmark (default: PyRadiomics defaults)')
+    parser.add_argument('--split_image_types', action='store_true',
+                        help='Also extract the image types of one subject in parallel in the batch benchmark')
+    parser.add_argument('--job_overhead', type=float, default=180.0,
+                        help='Start up time of one SageMaker processing job in seconds (default: 180)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        if args.synthetic:
+            args.data_dir = synthetic_dir
+            for i in range(args.synthetic):
+                write_synthetic_subject(synthetic_dir, 'SYN-%03d' % i, n_slices=args.slices, seed=i)
+        BENCHMARKS[args.benchmark](args)
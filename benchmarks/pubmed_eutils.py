@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the PubMed action group against a local fake E-utilities server.
+
+    python benchmarks/pubmed_eutils.py efetch --latency 0.05
+"""
+import argparse
+import collections
+import gzip
+import io
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ActionGroups', 'pubmed-lambda-function'))
+import xmltodict  # noqa: E402
+from PubMed import PubMed  # noqa: E402
+from article_parser import iter_articles  # noqa: E402
+from article_store import ArticleStore, PartWriter, build_index  # noqa: E402
+from baseline_ingest import ingest  # noqa: E402
+from literature_index import LiteratureIndex  # noqa: E402
+
+
+FIRST_UID = 30000000
+
+
+def article_xml(uid, n_mesh=25, n_authors=12, n_references=40):
+    """ A PubmedArticle shaped like a real efetch record, with the MeSH, authors and references we never read """
+    authors = ''.join(
+        f'<Author ValidYN="Y"><LastName>Author{i}</LastName><ForeName>A</ForeName><Initials>A</Initials>'
+        f'<AffiliationInfo><Affiliation>Department {i}, Example University, Stanford, CA, USA.</Affiliation>'
+        f'</AffiliationInfo></Author>' for i in range(n_authors))
+    mesh = ''.join(
+        f'<MeshHeading><DescriptorName UI="D{i:06d}" MajorTopicYN="N">Heading {i}</DescriptorName>'
+        f'<QualifierName UI="Q{i:06d}" MajorTopicYN="Y">genetics</QualifierName></MeshHeading>'
+        for i in range(n_mesh))
+    references = ''.join(
+        f'<Reference><Citation>Reference {i}. J Example. 2015;{i}:1-10.</Citation><ArticleIdList>'
+        f'<ArticleId IdType="pubmed">{20000000 + i}</ArticleId></ArticleIdList></Reference>'
+        for i in range(n_references))
+    sentence = 'LRIG1 expression was associated with survival in non-small cell lung cancer patients. '
+    return (
+        f'<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">{uid}</PMID>'
+        f'<Article PubModel="Print"><Journal><Title>Example Journal</Title></Journal>'
+        f'<ArticleTitle>Biomarker study {uid} of LRIG1 in lung adenocarcinoma.</ArticleTitle>'
+        f'<Abstract><AbstractText Label="BACKGROUND">{sentence * 3}</AbstractText>'
+        f'<AbstractText Label="METHODS">{sentence * 4}</AbstractText>'
+        f'<AbstractText Label="RESULTS">{sentence * 5}</AbstractText>'
+        f'<AbstractText Label="CONCLUSIONS">{sentence * 2}</AbstractText>'
+        f'<CopyrightInformation>Copyright 2020.</CopyrightInformation></Abstract>'
+        f'<AuthorList CompleteYN="Y">{authors}</AuthorList>'
+        f'<ArticleDate DateType="Electronic"><Year>2020</Year><Month>05</Month><Day>14</Day></ArticleDate>'
+        f'</Article><MeshHeadingList>{mesh}</MeshHeadingList></MedlineCitation>'
+        f'<PubmedData><ReferenceList>{references}</ReferenceList></PubmedData></PubmedArticle>'
+    )
+
+
+def article_set_xml(uids):
+    return ('<?xml version="1.0" ?><!DOCTYPE PubmedArticleSet><PubmedArticleSet>'
+            + ''.join(article_xml(uid) for uid in uids) + '</PubmedArticleSet>')
+
+
+class FakeEutils(BaseHTTPRequestHandler):
+    """ esearch returns consecutive ids, efetch returns synthetic articles for the requested ids """
+
+    # keep-alive unless the client asks to close, like NCBI
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes, Nagle would hold the body for a delayed ACK on a kept-alive socket
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+        # stands in for the TCP and TLS handshakes of a new connection
+        time.sleep(self.server.handshake)
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(url.query)
+        with self.server.lock:
+            self.server.requests += 1
+            now = time.monotonic()
+            recent = self.server.recent
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            throttled = self.server.rate_limit and len(recent) >= self.server.rate_limit
+            if throttled:
+                self.server.throttled += 1
+            else:
+                recent.append(now)
+        time.sleep(self.server.latency)
+        if throttled:
+            self.send_response(429)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if url.path.endswith('esearch.fcgi'):
+            retmax = int(params.get('retmax', ['20'])[0])
+            body = json.dumps({'esearchresult': {
+                'count': str(retmax), 'webenv': 'MCID_fake', 'querykey': '1',
+                'idlist': [str(FIRST_UID + i) for i in range(retmax)]}})
+            content_type = 'application/json'
+        else:
+            body = article_set_xml(params['id'][0].split(','))
+            content_type = 'text/xml'
+        data = body.encode('utf-8')
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip.compress(data, compresslevel=6)
+            self.send_header('Content-Encoding', 'gzip')
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(latency, handshake=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEutils)
+    server.latency = latency
+    server.handshake = handshake
+    server.requests = 0
+    server.connections = 0
+    server.bytes_sent = 0
+    # like NCBI, answer 429 once more than rate_limit requests arrive within one second
+    server.rate_limit = 0
+    server.recent = collections.deque()
+    server.throttled = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fake_pubmed(server, top_k):
+    pubmed = PubMed()
+    base = f'http://127.0.0.1:{server.server_address[1]}/entrez/eutils/'
+    pubmed.base_url_esearch = base + 'esearch.fcgi?'
+    pubmed.base_url_efetch = base + 'efetch.fcgi?'
+    pubmed.top_k_results = top_k
+    return pubmed
+
+
+def bench_efetch(server, args):
+    """ One efetch per article (the previous behaviour) vs one batched efetch """
+    print('%6s %14s %10s %14s %10s %8s' % ('top_k', 'per_article_s', 'requests', 'batched_s', 'requests', 'speedup'))
+    for top_k in args.top_k:
+        pubmed = fake_pubmed(server, top_k)
+        server.requests = 0
+        start = time.perf_counter()
+        uids = [str(FIRST_UID + i) for i in range(top_k)]
+        urllib.request.urlopen(pubmed.base_url_esearch + f'db=pubmed&term=x&retmode=json&retmax={top_k}').read()
+        for uid in uids:
+            pubmed.retrieve_article(uid, 'MCID_fake')
+        per_article, per_article_requests = time.perf_counter() - start, server.requests
+
+        server.requests = 0
+        start = time.perf_counter()
+        docs = pubmed.load('LRIG1 lung cancer survival')
+        batched, batched_requests = time.perf_counter() - start, server.requests
+        assert len(docs) == top_k
+        print('%6d %14.3f %10d %14.3f %10d %8.1f' % (top_k, per_article, per_article_requests,
+                                                     batched, batched_requests, per_article / batched))
+
+
+def bench_ratelimit(server, args):
+    """ Unbatched (one id per efetch) concurrent retrieval against a server that enforces 3 requests/second """
+    server.rate_limit = 3
+    print('%6s %8s %10s %10s %12s %10s' % ('top_k', 'workers', 'seconds', 'requests', 'requests/s', 'http_429'))
+    for top_k in args.top_k:
+        pubmed = fake_pubmed(server, top_k)
+        pubmed.efetch_batch_size = 1
+        server.requests = server.throttled = 0
+        start = time.perf_counter()
+        docs = pubmed.load('LRIG1 lung cancer survival')
+        elapsed = time.perf_counter() - start
+        assert len(docs) == top_k
+        print('%6d %8d %10.2f %10d %12.2f %10d' % (top_k, pubmed.max_workers, elapsed, server.requests,
+                                                   server.requests / elapsed, server.throttled))
+
+
+def xmltodict_articles(xml_bytes):
+    """ The previous parsing path: decode the whole body, build the full xmltodict tree, then read a few fields """
+    text_dict = xmltodict.parse(xml_bytes.decode('utf-8'), force_list=('PubmedArticle',))
+    articles = []
+    for article in text_dict['PubmedArticleSet']['PubmedArticle']:
+        ar = article['MedlineCitation']['Article']
+        abstract_text = ar.get('Abstract', {}).get('AbstractText', [])
+        a_d = ar.get('ArticleDate', {})
+        articles.append({
+            'uid': article['MedlineCitation']['PMID']['#text'],
+            'Title': ar.get('ArticleTitle', ''),
+            'Published': '-'.join([a_d.get('Year', ''), a_d.get('Month', ''), a_d.get('Day', '')]),
+            'Summary': '\n'.join(f"{txt['@Label']}: {txt['#text']}" for txt in abstract_text),
+        })
+    return articles
+
+
+def bench_parse(server, args):
+    """ Full xmltodict tree vs streaming extraction on multi-article efetch payloads """
+    print('%9s %8s %12s %12s %14s %14s' % ('articles', 'MB', 'xmltodict_s', 'stream_s', 'xmltodict_MB', 'stream_MB'))
+    for n_articles in args.top_k:
+        payload = article_set_xml([str(FIRST_UID + i) for i in range(n_articles)]).encode('utf-8')
+        timings, peaks = [], []
+        for parse in (xmltodict_articles, lambda data: list(iter_articles(io.BytesIO(data)))):
+            tracemalloc.start()
+            start = time.process_time()
+            articles = parse(payload)
+            timings.append(time.process_time() - start)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 2 ** 20)
+            tracemalloc.stop()
+            assert len(articles) == n_articles
+        print('%9d %8.1f %12.3f %12.3f %14.1f %14.1f' % (n_articles, len(payload) / 2 ** 20, *timings, *peaks))
+
+
+def bench_cache(server, args):
+    """ Cold search vs repeated search served by the in-process LRU and by the disk tier of a fresh process """
+    print('%6s %10s %10s %10s %10s %10s' % ('top_k', 'cold_ms', 'memory_ms', 'disk_ms', 'requests', 'hit_ratio'))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for top_k in args.top_k:
+            timings = []
+            server.requests = 0
+            pubmed = fake_pubmed(server, top_k)
+            pubmed.cache_dir = cache_dir
+            for instance in (pubmed, pubmed, fake_pubmed(server, top_k)):
+                # the last instance starts with an empty LRU, as a new Lambda container would
+                instance.cache_dir = cache_dir
+                start = time.perf_counter()
+                docs = instance.load('LRIG1 lung cancer survival')
+                timings.append((time.perf_counter() - start) * 1000)
+                assert len(docs) == top_k
+            hit_ratio = pubmed._article_cache.stats()['hit_ratio']
+            print('%6d %10.1f %10.2f %10.2f %10d %10.2f' % (top_k, *timings, server.requests, hit_ratio))
+
+
+GENES = ['lrig1', 'hpgd', 'gdf15', 'cdh2', 'postn', 'vcan', 'pdgfra', 'vcam1', 'cd44', 'cd48', 'cd4',
+         'lyl1', 'spi1', 'cd37', 'vim', 'lmo2', 'egr2', 'bgn', 'col4a1', 'col5a1', 'col5a2']
+
+
+def synthetic_abstracts(n_docs, vocabulary=40000, length=220, seed=0):
+    """ Abstracts drawn from a Zipf distributed vocabulary, each mentioning a few genes """
+    rng = random.Random(seed)
+    words = [f'w{rank}' for rank in range(vocabulary)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** 1.05 for rank in range(vocabulary)))
+    for uid in range(FIRST_UID, FIRST_UID + n_docs):
+        text = rng.choices(words, cum_weights=cum_weights, k=length) + rng.sample(GENES, 2)
+        rng.shuffle(text)
+        yield {'uid': str(uid), 'Title': ' '.join(text[:12]), 'Published': '2020-05-14',
+               'Copyright Information': '', 'Summary': ' '.join(text[12:])}
+
+
+def bench_index(server, args):
+    """ Local BM25 index: build, segment size and load time, then query latency exact and with a postings budget """
+    start = time.perf_counter()
+    index = LiteratureIndex()
+    index.add(synthetic_abstracts(args.docs))
+    built = time.perf_counter() - start
+    segment = index.to_bytes()
+    start = time.perf_counter()
+    index = LiteratureIndex.from_bytes(segment)
+    print('%d abstracts: built in %.1f s, %.1f MB segment loaded in %.2f s'
+          % (len(index), built, len(segment) / 2 ** 20, time.perf_counter() - start))
+
+    queries = ['lrig1 w0 w1 w3', 'w5 w10 w200', 'lrig1 w5000 w12', 'gdf15 w300 w77', 'w0 w1 w2 w3 w4',
+               'w999 w3000 w7', 'lrig1 gdf15 w20']
+    max_postings = PubMed.index_max_postings
+    # recall: share of the exact top-k BM25 score mass the budgeted search returns (ties make uids ambiguous)
+    print('%-18s %3s %10s %10s %12s %12s %8s' % ('query', 'k', 'exact_ms', 'p95_ms', 'budget_ms', 'p95_ms', 'recall'))
+    for k in (5, 2 * 5):
+        for query in queries:
+            row, mass = [], []
+            for budget in (None, max_postings):
+                timings = []
+                for _ in range(21):
+                    start = time.perf_counter()
+                    results = index.search(query, k, 0.0, budget)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                row += [timings[10], timings[19]]
+                mass.append(sum(score for _, score in results))
+            print('%-18s %3d %10.2f %10.2f %12.2f %12.2f %8.3f'
+                  % (query, k, *row, mass[1] / mass[0] if mass[0] else 1.0))
+
+
+def bench_ingest(server, args):
+    """ Baseline ingestion of gzip files with one worker and with every core, then uid lookups in the store """
+    n_files = max(args.files, 1)
+    per_file = args.docs // n_files
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(tmp, f'pubmed24n{i + 1:04d}.xml.gz')
+            with gzip.open(path, 'wt', encoding='utf-8') as f:
+                f.write(article_set_xml([str(FIRST_UID + i * per_file + j) for j in range(per_file)]))
+            paths.append(path)
+        print('%8s %10s %10s %14s' % ('workers', 'articles', 'seconds', 'articles/s'))
+        for workers in sorted({1, os.cpu_count() or 1}):
+            report = ingest(paths, os.path.join(tmp, f'store{workers}'), workers)
+            print('%8d %10d %10.2f %14d' % (workers, report['articles_parsed'], report['total_seconds'],
+                                             report['articles_per_second']))
+        store = ArticleStore(os.path.join(tmp, 'store1'))
+        uids = [str(FIRST_UID + i) for i in range(0, len(store), max(len(store) // 1000, 1))]
+        start = time.perf_counter()
+        articles = [store.get(uid) for uid in uids]
+        print('%d lookups: %.1f us each' % (len(articles), (time.perf_counter() - start) / len(articles) * 1e6))
+        assert all(article and article['MeSH'] for article in articles)
+
+
+def bench_parts(server, args):
+    """
+    Index build over more parts than the open file limit, as with the full MEDLINE baseline plus its
+    update files, checked against the last record of every uid with deletions applied
+    """
+    rng = random.Random(0)
+    latest = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        parts = []
+        for part_number in range(args.parts):
+            writer = PartWriter(os.path.join(tmp, f'part{part_number:04d}'))
+            for row in range(20):
+                uid = rng.randrange(args.parts * 10)
+                writer.add({'uid': str(uid), 'Title': f'title {uid}'})
+                latest[uid] = (part_number, row)
+            for _ in range(2):
+                uid = rng.randrange(args.parts * 10)
+                writer.delete(str(uid))
+                latest.pop(uid, None)
+            writer.close()
+            parts.append(f'part{part_number:04d}')
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = min(1024, args.parts, hard if hard != resource.RLIM_INFINITY else 1024)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+        try:
+            start = time.perf_counter()
+            count = build_index(tmp, parts)
+            elapsed = time.perf_counter() - start
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        store = ArticleStore(tmp)
+        assert count == len(latest) and list(store.uids) == sorted(latest)
+        assert all(store.get(str(uid))['Title'] == f'title {uid}' for uid in latest)
+        print('%d parts with at most %d open files: %d articles indexed in %.2f s' % (
+            args.parts, limit, count, elapsed))
+
+
+def bench_rerank(server, args):
+    """ Cost of reranking over-fetched candidates, alone and within a full search, against plain top_k """
+    query = 'LRIG1 expression and survival in lung adenocarcinoma'
+    pubmed = PubMed()
+    print('%10s %12s' % ('candidates', 'rerank_ms'))
+    for n_candidates in (20, 50, 100, 200):
+        candidates = list(synthetic_abstracts(n_candidates, seed=n_candidates))
+        timings = []
+        for _ in range(21):
+            start = time.perf_counter()
+            pubmed.rerank_articles(query, candidates)
+            timings.append((time.perf_counter() - start) * 1000)
+        print('%10d %12.2f' % (n_candidates, sorted(timings)[10]))
+
+    print('%6s %12s %14s %10s' % ('top_k', 'plain_ms', 'reranked_ms', 'requests'))
+    for top_k in args.top_k:
+        timings = []
+        for rerank in (False, True):
+            instance = fake_pubmed(server, top_k)
+            instance.rerank = rerank
+            instance.local_index = False
+            server.requests = 0
+            start = time.perf_counter()
+            docs = instance.load(query)
+            timings.append((time.perf_counter() - start) * 1000)
+            assert len(docs) == top_k
+        print('%6d %12.1f %14.1f %10d' % (top_k, *timings, server.requests))
+
+
+class UrllibPubMed(PubMed):
+    """ The previous transport: a new connection per request through urllib, without gzip """
+
+    def _urlopen(self, url):
+        self._rate_limiter().acquire()
+        return urllib.request.urlopen(url)
+
+
+def bench_session(server, args):
+    """ Sequential searches through urllib (new connection, identity encoding) vs the pooled gzip session """
+    print('%6s %10s %12s %12s %12s %10s %14s' % ('top_k', 'transport', 'seconds', 'connections',
+                                                  'requests', 'KB_sent', 'ms/request'))
+    for top_k in args.top_k:
+        for transport in (UrllibPubMed, PubMed):
+            pubmed = transport()
+            pubmed.base_url_esearch, pubmed.base_url_efetch = (fake_pubmed(server, top_k).base_url_esearch,
+                                                               fake_pubmed(server, top_k).base_url_efetch)
+            pubmed.top_k_results = top_k
+            pubmed.local_index = False
+            # the comparison is about the transport, not NCBI pacing
+            pubmed.rate_limit_headroom = 1000.0
+            server.requests = server.connections = server.bytes_sent = 0
+            start = time.perf_counter()
+            for i in range(10):
+                assert len(pubmed.load(f'LRIG1 lung cancer survival {i}')) == top_k
+            elapsed = time.perf_counter() - start
+            print('%6d %10s %12.2f %12d %12d %10.1f %14.1f' % (
+                top_k, 'urllib' if transport is UrllibPubMed else 'session', elapsed, server.connections,
+                server.requests, server.bytes_sent / 1024, elapsed / server.requests * 1000))
+
+
+BENCHMARKS = {
+    'session': bench_session,
+    'rerank': bench_rerank,
+    'ingest': bench_ingest,
+    'parts': bench_parts,
+    'index': bench_index,
+    'cache': bench_cache,
+    'efetch': bench_efetch,
+    'ratelimit': bench_ratelimit,
+    'parse': bench_parse,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated round trip time of the fake server in seconds (default: 0.05)')
+    parser.add_argument('--handshake', type=float, default=0.0,
+                        help='Simulated connection setup time in seconds, e.g. 0.1 for TCP and TLS (default: 0)')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[5, 20, 100],
+                        help='Result counts to benchmark (default: 5 20 100)')
+    parser.add_argument('--docs', type=int, default=100000,
+                        help='Abstracts in the index and ingest benchmarks (default: 100000)')
+    parser.add_argument('--files', type=int, default=8,
+                        help='Baseline files in the ingest benchmark (default: 8)')
+    parser.add_argument('--parts', type=int, default=1200,
+                        help='Parts in the parts benchmark, more than the open file limit (default: 1200)')
+    args = parser.parse_args()
+
+    server = serve(args.latency, args.handshake)
+    try:
+        BENCHMARKS[args.benchmark](server, args)
+    finally:
+        server.shutdown()